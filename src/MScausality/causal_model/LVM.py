@@ -2,24 +2,43 @@
 from MScausality.simulation.simulation import simulate_data
 from MScausality.data_analysis.dataProcess import dataProcess
 from MScausality.data_analysis.normalization import normalize
-from MScausality.causal_model.models import ProteomicPerturbationModel, ProteomicPerturbationCATE
-from MScausality.causal_model.models import NumpyroProteomicPerturbationModel
-from MScausality.causal_model.utils import prep_data_for_model
-
+from MScausality.causal_model.models import ProteomicPerturbationModel, ProteomicPerturbationCATE, \
+    VectorizedProteomicPerturbationModel
+from MScausality.causal_model.models import NumpyroProteomicPerturbationModel, NumpyroVectorizedPerturbationModel, \
+    propagate_censored_moments
+from MScausality.causal_model.priors import PriorStore
+from MScausality.causal_model.utils import prep_data_for_model, build_model_structure, \
+    compile_graph, prep_matrix_data_for_model, unpack_samples, build_spline_basis, \
+    calc_probit_detection, \
+    streaming_moments, summarize_samples, iterate_minibatches, pad_run_sites
+
+import os
+import json
+import shutil
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
-from operator import attrgetter
+from functools import partial
 
 import torch
 import pyro
 from pyro import poutine
 from pyro.infer.autoguide import AutoDelta, AutoMultivariateNormal, AutoGuideList, AutoNormal
-from pyro.infer import SVI, Trace_ELBO
+from pyro.infer import SVI, Trace_ELBO, JitTrace_ELBO, JitTraceMeanField_ELBO
+from pyro.infer.autoguide import init_to_value as pyro_init_to_value
 
 import numpyro
 from numpyro.infer import MCMC, NUTS
+from numpyro.infer import init_to_value
+from numpyro.infer.util import initialize_model
+from numpyro.infer.hmc import hmc
+from numpyro.distributions.transforms import biject_to
 from numpyro.infer import Predictive
+from numpyro.infer import SVI as NumpyroSVI, Trace_ELBO as NumpyroTrace_ELBO
+from numpyro.infer import autoguide as numpyro_autoguide
+import jax
 from jax import random
+from jax import numpy as jnp
 
 from sklearn.linear_model import LinearRegression
 import statsmodels.api as sm
@@ -29,13 +48,329 @@ import y0
 from y0.dsl import Variable
 from y0.algorithm.simplify_latent import simplify_latent_dag
 
-numpyro.set_platform('cpu')
-numpyro.set_host_device_count(4)
+# Compiled MCMC samplers shared across LVM fits, see LVM.mcmc_cache_key. 
+# The least recently used entry is dropped beyond MCMC_CACHE_SIZE entries.
+MCMC_CACHE = OrderedDict()
+MCMC_CACHE_SIZE = 8
+
+# LVM settings written by LVM.save
+SAVED_SETTINGS = ["backend", "num_samples", "warmup_steps", "num_chains", 
+                  "num_steps", "initial_lr", "gamma", "patience", "min_delta", 
+                  "vectorized", "guide_type", "cache_mcmc", "chain_method", 
+                  "summarize_imputation", "summary_chunk_size", "batch_size", 
+                  "elbo", "loss_window", "spline_edges", "n_knots", 
+                  "missing_model"]
 
 # TODO: give user the option to reset parameters or not (new models vs more training)
 # pyro.clear_param_store()
 # pyro.settings.set(module_local_params=True)
 
+def available_cpu_count():
+
+    """
+    Number of CPU cores this process is allowed to run on.
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def configure_devices(num_devices=None, platform="cpu"):
+
+    """
+    Set the jax platform and the number of host devices numpyro can run 
+    parallel chains on. This has to be called when the process starts, 
+    before jax initializes its backend, and is never done on import.
+
+    Parameters
+    ----------
+    num_devices : int
+        Number of host devices. Defaults to the number of available cores.
+    platform : str
+        The jax platform to run on.
+
+    Returns
+    -------
+    int
+        The number of host devices requested.
+    """
+
+    if num_devices is None:
+        num_devices = available_cpu_count()
+
+    numpyro.set_platform(platform)
+    numpyro.set_host_device_count(num_devices)
+
+    return num_devices
+
+def clear_mcmc_cache():
+
+    """
+    Drop every cached MCMC sampler and the device buffers it holds.
+    """
+
+    MCMC_CACHE.clear()
+
+def build_cached_sampler(model, model_kwargs, num_warmup, num_samples, 
+                         num_chains, chain_method="parallel", rng_key=None):
+
+    """
+    Initialize NUTS chains and compile a sampling loop that can be rerun on 
+    new model arguments of the same shape. On a rerun, warmup starts from 
+    the adapted step size and mass matrix of the previous run instead of the 
+    defaults.
+
+    Parameters
+    ----------
+    model : callable
+        The numpyro model.
+    model_kwargs : dict
+        Keyword arguments of the model used to initialize the chains.
+    num_warmup : int
+        Number of warmup steps per chain.
+    num_samples : int
+        Number of samples to draw per chain.
+    num_chains : int
+        Number of chains.
+    chain_method : str
+        One of "parallel", "vectorized" or "sequential".
+    rng_key : jax.random.PRNGKey
+        Key the chains are initialized from. Defaults to PRNGKey(0).
+
+    Returns
+    -------
+    tuple
+        Jitted function mapping (state, model_kwargs) to the final state and 
+        the constrained samples grouped by chain, and the initial state.
+    """
+
+    sampler = NUTS(model)
+    if rng_key is None:
+        rng_key = random.PRNGKey(0)
+    if num_chains > 1:
+        rng_key = random.split(rng_key, num_chains)
+
+    # With vectorized chains the initialized sampler already steps all 
+    # chains at once, only the energy reset has to be vmapped
+    batched = num_chains > 1 and chain_method == "vectorized"
+    if batched or num_chains == 1:
+        state = sampler.init(rng_key, num_warmup, model_kwargs=model_kwargs)
+    else:
+        # Chains are initialized one by one so the sampler steps one chain
+        state = jax.tree.map(lambda *values: jnp.stack(values), 
+                             *[sampler.init(key, num_warmup, 
+                                            model_kwargs=model_kwargs) 
+                               for key in rng_key])
+
+    def reset_chain(state, model_kwargs):
+
+        # The cached potential energy and gradient belong to the previous 
+        # data, so they are recomputed before sampling
+        potential_fn = sampler.get_potential_fn(model_kwargs=model_kwargs)
+        potential_energy, z_grad = jax.value_and_grad(potential_fn)(state.z)
+        return state._replace(i=jnp.zeros_like(state.i),
+                              potential_energy=potential_energy, 
+                              z_grad=z_grad)
+
+    def run_chain(state, model_kwargs):
+
+        if batched:
+            state = jax.vmap(reset_chain, in_axes=(0, None))(state, 
+                                                             model_kwargs)
+        else:
+            state = reset_chain(state, model_kwargs)
+
+        def warmup_fn(state, _):
+            return sampler.sample(state, (), model_kwargs), None
+
+        def body_fn(state, _):
+            state = sampler.sample(state, (), model_kwargs)
+            return state, state.z
+
+        state, _ = jax.lax.scan(warmup_fn, state, None, length=num_warmup)
+        state, z = jax.lax.scan(body_fn, state, None, length=num_samples)
+        postprocess_fn = jax.vmap(sampler.postprocess_fn((), model_kwargs))
+        if batched:
+            # Draws are stacked along the first axis, chains along the second
+            z = jax.tree.map(lambda value: jnp.swapaxes(value, 0, 1), z)
+            postprocess_fn = jax.vmap(postprocess_fn)
+        return state, postprocess_fn(z)
+
+    if num_chains > 1 and chain_method == "parallel":
+        return jax.pmap(run_chain, in_axes=(0, None)), state
+
+    def run(state, model_kwargs):
+        if batched:
+            return run_chain(state, model_kwargs)
+        if num_chains > 1:
+            return jax.lax.map(lambda chain_state: run_chain(chain_state, 
+                                                             model_kwargs), 
+                               state)
+        state, samples = run_chain(state, model_kwargs)
+        return state, {key: value[None] for key, value in samples.items()}
+
+    return jax.jit(run), state
+
+def build_batched_sampler(model, model_kwargs, batched_kwargs, num_warmup, 
+                          num_samples, num_chains, chain_method="vectorized"):
+
+    """
+    Compile one NUTS program that fits a model to a batch of datasets of the 
+    same shape. Datasets are vectorized, every chain has its own warmup and 
+    adapts its own step size and mass matrix.
+
+    Parameters
+    ----------
+    model : callable
+        The numpyro model.
+    model_kwargs : dict
+        Keyword arguments shared by every dataset, e.g. the priors.
+    batched_kwargs : dict
+        Keyword arguments stacked along a leading dataset dimension.
+    num_warmup : int
+        Number of warmup steps per chain.
+    num_samples : int
+        Number of samples to draw per chain.
+    num_chains : int
+        Number of chains per dataset.
+    chain_method : str
+        "parallel" runs the chains on separate devices, otherwise chains are 
+        vectorized together with the datasets.
+
+    Returns
+    -------
+    callable
+        Jitted function mapping (rng_key, batched_kwargs) to the constrained 
+        samples with shape (datasets x chains x samples x ...).
+    """
+
+    example_kwargs = jax.tree.map(lambda x: x[0], batched_kwargs)
+    param_info, potential_fn_gen, postprocess_fn_gen, _ = initialize_model(
+        random.PRNGKey(0), model, 
+        model_kwargs={**model_kwargs, **example_kwargs}, dynamic_args=True)
+    init_kernel, sample_kernel = hmc(potential_fn_gen=potential_fn_gen, 
+                                     algo="NUTS")
+    init_template = param_info.z
+
+    def run_chain(rng_key, data_kwargs):
+        kwargs = {**model_kwargs, **data_kwargs}
+
+        # Uniform initialization in unconstrained space, as init_to_uniform
+        rng_key, init_key = random.split(rng_key)
+        init_keys = random.split(init_key, len(init_template))
+        init_params = {name: random.uniform(key, jnp.shape(value), 
+                                            minval=-2., maxval=2.) 
+                       for key, (name, value) 
+                       in zip(init_keys, init_template.items())}
+        state = init_kernel(init_params, num_warmup, model_kwargs=kwargs, 
+                            rng_key=rng_key)
+
+        def warmup_fn(state, _):
+            return sample_kernel(state, model_kwargs=kwargs), None
+
+        def body_fn(state, _):
+            state = sample_kernel(state, model_kwargs=kwargs)
+            return state, state.z
+
+        state, _ = jax.lax.scan(warmup_fn, state, None, length=num_warmup)
+        state, z = jax.lax.scan(body_fn, state, None, length=num_samples)
+        return jax.vmap(postprocess_fn_gen(**kwargs))(z)
+
+    run_datasets = jax.vmap(run_chain)
+
+    if num_chains > 1 and chain_method == "parallel":
+        run_chains = jax.pmap(run_datasets, in_axes=(0, None))
+    else:
+        run_chains = jax.jit(jax.vmap(run_datasets, in_axes=(0, None)))
+
+    def run(rng_key, batched_kwargs):
+        num_datasets = len(jax.tree.leaves(batched_kwargs)[0])
+        keys = random.split(rng_key, num_chains * num_datasets)
+        keys = keys.reshape((num_chains, num_datasets) + keys.shape[1:])
+        samples = run_chains(keys, batched_kwargs)
+        return {key: jnp.swapaxes(value, 0, 1) 
+                for key, value in samples.items()}
+
+    return run
+
+class CachedJitTraceMeanField_ELBO(JitTraceMeanField_ELBO):
+
+    """
+    `JitTraceMeanField_ELBO` that compiles its loss once. Pyro checks for 
+    the compiled loss under an attribute it never sets, and so traces the 
+    model again on every step.
+    """
+
+    def differentiable_loss(self, model, guide, *args, **kwargs):
+        loss = super().differentiable_loss(model, guide, *args, **kwargs)
+        self._loss_and_surrogate_loss = self._differentiable_loss
+        return loss
+
+def run_svi_steps(step_fn, num_steps, patience, min_delta, window=100, 
+                  verbose=True):
+
+    """
+    Run an SVI optimization loop with early stopping. Losses are only 
+    pulled from the device, logged and checked for convergence once per 
+    window of steps, using the mean loss of the window.
+
+    Parameters
+    ----------
+    step_fn : callable
+        Takes no arguments, runs one optimization step and returns its loss.
+    num_steps : int
+        Maximum number of steps.
+    patience : int
+        Number of steps without improvement before stopping.
+    min_delta : float
+        Decrease of the window loss that counts as an improvement.
+    window : int
+        Number of steps per window.
+    verbose : bool
+        Whether to print the window losses.
+
+    Returns
+    -------
+    pd.DataFrame
+        Loss history with the loss of every step and the mean loss of the 
+        window it belongs to.
+    """
+
+    losses = list()
+    window_losses = list()
+    best_loss = float('inf')
+    steps_since_improvement = 0
+
+    for step in range(num_steps):
+        window_losses.append(step_fn())
+        if len(window_losses) < window and step < num_steps - 1:
+            continue
+
+        values = [float(loss) for loss in window_losses]
+        window_losses = list()
+        losses.extend(values)
+        loss = np.mean(values)
+        if verbose:
+            print(f"Step {step}: Loss = {loss}")
+
+        # Check for improvement
+        if loss < best_loss - min_delta:
+            best_loss = loss
+            steps_since_improvement = 0
+        else:
+            steps_since_improvement += len(values)
+
+        # Early stopping condition
+        if steps_since_improvement >= patience:
+            print(f"Stopping early at step {step} with loss {loss}")
+            break
+
+    history = pd.DataFrame({"step": np.arange(len(losses)), "loss": losses})
+    history["window_loss"] = history.groupby(
+        history["step"] // window)["loss"].transform("mean")
+
+    return history
+
 class LVM:
     def __init__(self, backend="numpyro", 
                  num_samples=1000, 
@@ -44,7 +379,19 @@ class LVM:
                  num_steps=2000, 
                  initial_lr=.01, gamma=.01,
                  patience=300, min_delta=5,
-                 informative_priors=None):
+                 informative_priors=None,
+                 vectorized=False,
+                 guide_type="AutoNormal",
+                 cache_mcmc=False,
+                 chain_method="auto",
+                 summarize_imputation=True,
+                 summary_chunk_size=256,
+                 batch_size=None,
+                 elbo="Trace_ELBO",
+                 loss_window=100,
+                 spline_edges=None,
+                 n_knots=3,
+                 missing_model="imputation"):
         
         self.backend = backend
         self.num_samples = num_samples
@@ -56,6 +403,18 @@ class LVM:
         self.patience = patience
         self.min_delta = min_delta
         self.informative_priors = informative_priors
+        self.vectorized = vectorized
+        self.guide_type = guide_type
+        self.cache_mcmc = cache_mcmc
+        self.chain_method = chain_method
+        self.summarize_imputation = summarize_imputation
+        self.summary_chunk_size = summary_chunk_size
+        self.batch_size = batch_size
+        self.elbo = elbo
+        self.loss_window = loss_window
+        self.spline_edges = spline_edges
+        self.n_knots = n_knots
+        self.missing_model = missing_model
 
     def __repr__(self):
         return f"Latent Variable Structural Causal Model"
@@ -79,59 +438,18 @@ class LVM:
             A dictionary containing the descendent nodes for each root node.
         """
 
-        # Sort graph
-        sorted_nodes = [i for i in self.causal_graph.topological_sort()]
+        compiled = compile_graph(self.causal_graph)
 
-        # Get ancestors of each node
-        ancestors = {i: list(self.causal_graph.ancestors_inclusive(i)) \
-                     for i in sorted_nodes}
-
-        # Find starting nodes
-        root_nodes = [i for i in sorted_nodes if len(ancestors[i]) == 1]
-        descendent_nodes = [i for i in sorted_nodes if len(ancestors[i]) != 1]
-
-        temp_descendent_nodes = dict()
-        for i in descendent_nodes:
-            temp_descendent_nodes[i] = [
-                i[0] for i in list(self.causal_graph.directed.in_edges(i))
-                ]
-            
-        descendent_nodes = temp_descendent_nodes
-
-        # Find latent confounder nodes
-        latent_edges = list(self.causal_graph.undirected.edges())
-        latent_nodes = ["latent_{}".format(i) for i in range(len(latent_edges))]
-
-        # Add in latent confounders to descendent nodes
-        for i in range(len(latent_nodes)):
-            root_nodes.append(latent_nodes[i])
-            for node in latent_edges[i]:
-                if node in root_nodes:
-                    temp = dict()
-                    root_nodes.remove(node)
-                    temp[node] = [latent_nodes[i]]
-                    temp.update(descendent_nodes)
-                    descendent_nodes = temp.copy()
-                else:
-                    descendent_nodes[node].append(latent_nodes[i])
-
-        # Finalize output
-        descendent_nodes = {
-            str(name): 
-            [str(item) for item in nodes if item != name] for name, nodes in 
-            descendent_nodes.items() if name in descendent_nodes
-            }
-        root_nodes = [str(i) for i in root_nodes]
-
-        self.root_nodes = root_nodes
-        self.descendent_nodes = descendent_nodes
+        self.root_nodes = compiled["root_nodes"]
+        self.descendent_nodes = compiled["descendent_nodes"]
+        self.structure = compiled["structure"]
 
     def parse_data(self):
 
         data = dict()
         missing = dict()
         for i in self.obs_data.columns:
-            if self.backend == "numpyro":
+            if self.backend in ["numpyro", "numpyro_svi"]:
                 data[i] = np.array(self.obs_data[i].values)
                 missing[i] = np.array(self.obs_data[i].isna().values)
             elif self.backend == "pyro":
@@ -142,45 +460,66 @@ class LVM:
         self.input_missing = pd.DataFrame.from_dict(missing)
 
     def parse_priors(self):
-        
-        priors = {}
 
-        if self.informative_priors is None:
-            inf_priors = list()
+        """
+        Build the per node priors from `informative_priors`, which can be a 
+        `PriorStore` or a per node dictionary. Nodes without informative 
+        priors get an uninformative prior.
+        """
+
+        if isinstance(self.informative_priors, PriorStore):
+            self.prior_store = self.informative_priors
         else:
-            inf_priors = list(self.informative_priors.keys())
+            self.prior_store = PriorStore(self.informative_priors)
 
         # TODO: determine correct scale for uninformative priors
-        for col in self.root_nodes:
-            if col in inf_priors:
-                priors[col] = {
-                    f"{col}_int": self.informative_priors[col][f"{col}_int"],
-                    f"{col}_int_scale": self.informative_priors[col][f"{col}_int_scale"]}
-            else:
-                priors[col] = {f"{col}_int": 0,
-                               f"{col}_int_scale": 10}
+        self.priors = self.prior_store.node_priors(self.root_nodes, 
+                                                   self.descendent_nodes)
 
-        for col, value in self.descendent_nodes.items():
-            
-            temp = {}
-            if col in inf_priors:
-                for v in value: 
-                    temp[f"{col}_{v}_coef"
-                         ] = self.informative_priors[col][f"{col}_{v}_coef"]
-                    temp[f"{col}_{v}_coef_scale"
-                         ] = self.informative_priors[col][f"{col}_{v}_coef_scale"]
-                temp[f"{col}_int"] = self.informative_priors[col][f"{col}_int"]
-                temp[f"{col}_int_scale"] = self.informative_priors[col][f"{col}_int_scale"]
-            else:
-                for v in value:
-                    temp[f"{col}_{v}_coef"] = 0
-                    temp[f"{col}_{v}_coef_scale"] = 10
-            
-                temp[f"{col}_int"] = 0
-                temp[f"{col}_int_scale"] = 10
-            priors[col] = temp
+    def parse_splines(self):
+
+        """
+        Place the knots of the piecewise-linear edges in `spline_edges` at 
+        quantiles of the observed parent values. Knots are kept fixed when 
+        the model is updated with new runs.
+        """
+
+        self.splines = None
+        if self.spline_edges is None:
+            return
+        if not self.vectorized:
+            raise ValueError("Spline edges require the vectorized model, "
+                             "set vectorized=True.")
 
-        self.priors = priors
+        data, missing = prep_matrix_data_for_model(self.structure, 
+                                                   self.input_data, 
+                                                   self.input_missing)
+        self.splines = build_spline_basis(self.structure, data, missing, 
+                                          self.spline_edges, self.n_knots)
+
+    def parse_missing_model(self):
+
+        """
+        Set up how missing values enter the likelihood. With "imputation" 
+        every missing value is a latent site of the model. With "mnar" 
+        missing values are integrated out under a probit detection model 
+        fit to the data with `calc_probit_detection`, which is kept fixed 
+        when the model is updated with new runs.
+        """
+
+        self.detection = None
+        if self.missing_model == "imputation":
+            return
+        if self.missing_model != "mnar":
+            raise ValueError(f"Unknown missing_model {self.missing_model}")
+        if self.backend not in ["numpyro", "numpyro_svi"] or \
+                not self.vectorized:
+            raise ValueError("The MNAR likelihood requires a numpyro backend "
+                             "and vectorized=True.")
+        if self.spline_edges is not None:
+            raise ValueError("The MNAR likelihood only supports linear edges.")
+
+        self.detection = calc_probit_detection(self.input_data)
 
     # TODO: Fix this for AutoDelta
     def compile_pyro_parameters(self):
@@ -192,6 +531,14 @@ class LVM:
         params = [i for i in pyro.get_param_store().items()]
         params = dict(params)
         params = {key : value.detach() for key, value in params.items()}
+        if self.vectorized:
+            # Split the array valued sites into the per node sites
+            params = unpack_samples(
+                {key.replace("AutoDelta.", ""): value 
+                 for key, value in params.items()}, self.structure, 
+                self.splines)
+            params = {f"AutoDelta.{key}": value 
+                      for key, value in params.items()}
         self.original_params = params
 
         loc_params = [i for i in params.keys() if ("imp" not in i)] #& \
@@ -208,62 +555,94 @@ class LVM:
         """
         Custom function to compile summary statistics from numpyro model.
 
+        Posterior moments and diagnostics are accumulated chunk by chunk, 
+        so the samples are never copied to host memory all at once. 
+        Imputation sites are left out of the diagnostics when 
+        `summarize_imputation` is False.
+
         :param model: trained mcmc model
         :param prob: the probability mass of samples within the HPDI interval.
 
         :return: dictionary of summary statistics.
         """
 
-        sites = self.model._states[self.model._sample_field]
+        sites = self.get_samples(group_by_chain=True)
 
-        if isinstance(sites, dict):
-            state_sample_field = attrgetter(
-                self.model._sample_field)(self.model._last_state)
-            if isinstance(state_sample_field, dict):
-                sites = {
-                    k: v
-                    for k, v in self.model._states[
-                        self.model._sample_field].items()
-                    if k in state_sample_field
-                }
-
-        for site_name in list(sites):
-            if len(sites[site_name].shape) == 3:
-                if sites[site_name].shape[2] == 0:
-                    # remove key from dictionary
-                    sites.pop(site_name)
-
-        summary_stats = numpyro.diagnostics.summary(sites, 
-                                                    prob, 
-                                                    group_by_chain=True)
+        if self.summarize_imputation:
+            site_filter = None
+        else:
+            site_filter = lambda name: "imp" not in name
+        summary_stats = summarize_samples(sites, prob, site_filter, 
+                                          self.summary_chunk_size)
+        moments = streaming_moments(sites, self.summary_chunk_size)
+
+        if self.vectorized:
+            summary_stats = {stat: unpack_samples(
+                {name: site_stats[stat] 
+                 for name, site_stats in summary_stats.items()}, 
+                self.structure, self.splines) 
+                for stat in summary_stats["intercept"]}
+            summary_stats = {name: {stat: summary_stats[stat][name] 
+                                    for stat in summary_stats} 
+                             for name in summary_stats["mean"]}
+            means = unpack_samples({name: value["mean"] for name, value 
+                                    in moments.items()}, self.structure, 
+                                   self.splines)
+            stds = unpack_samples({name: value["std"] for name, value 
+                                   in moments.items()}, self.structure, 
+                                  self.splines)
+            moments = {name: {"mean": means[name], "std": stds[name], 
+                              "n": moments["intercept"]["n"]} 
+                       for name in means}
 
-        sample_keys = list(self.model.get_samples().keys())
-        samples = self.model.get_samples()
         learned_params = dict()
 
-        for i in range(len(sample_keys)):
-            if "scale" not in sample_keys[i] and "imp" not in sample_keys[i]:
-                learned_params[
-                    f"{sample_keys[i]}"] = samples[
-                        sample_keys[i]].mean().item()
-                learned_params[
-                    f"{sample_keys[i]}_scale"] = self.model.get_samples()[
-                        sample_keys[i]].std().item()
-            elif "scale" in sample_keys[i]:
-                learned_params[
-                    f"{sample_keys[i]}"] = samples[sample_keys[i]].mean().item()
+        for name, site in moments.items():
+            if site["n"] == 0 or site["mean"].size == 0:
+                continue
+            if "scale" not in name and "imp" not in name:
+                # Pool the elementwise moments into scalar moments
+                mean = site["mean"].mean()
+                var = (site["std"]**2 + site["mean"]**2).mean() - mean**2
+                learned_params[name] = mean.item()
+                learned_params[f"{name}_scale"] = np.sqrt(max(var, 0.)).item()
+            elif "scale" in name:
+                learned_params[name] = site["mean"].mean().item()
             else:
-                learned_params[
-                    f"{sample_keys[i]}"] = samples[sample_keys[i]].mean(axis=0)
-                learned_params[
-                    f"{sample_keys[i]}_scale"] = samples[
-                        sample_keys[i]].std(axis=0)
+                learned_params[name] = site["mean"]
+                learned_params[f"{name}_scale"] = site["std"]
 
         self.learned_params = learned_params
         self.summary_stats = summary_stats
 
-    def train_numpyro(self, verbose=True):
-        
+    def prep_numpyro_inputs(self):
+
+        """
+        Build the numpyro model function and the arguments it is run with.
+
+        Returns
+        -------
+        model : callable
+            The numpyro model to fit, with the arguments that determine the 
+            shape of the model already bound.
+        model_kwargs : dict
+            The array valued keyword arguments passed to the model.
+        """
+
+        if self.vectorized:
+            data, missing = prep_matrix_data_for_model(self.structure, 
+                                                       self.input_data, 
+                                                       self.input_missing)
+            self.prior_arrays = self.prior_store.arrays(self.structure)
+
+            model = partial(NumpyroVectorizedPerturbationModel, 
+                            structure=self.structure, 
+                            splines=self.splines,
+                            detection=self.detection)
+            return model, {"data": data, 
+                           "missing": missing, 
+                           "priors": self.prior_arrays}
+
         condition_data = dict()
         condition_missing = dict()
         
@@ -278,117 +657,469 @@ class LVM:
                 np.nan_to_num(self.input_data.loc[:, node].values))
             condition_missing[f"{node}"] = np.array(
                 self.input_missing.loc[:, node].values)
-    
-        model = MCMC(NUTS(NumpyroProteomicPerturbationModel), 
-                    num_warmup=self.warmup_steps, 
-                    num_samples=self.num_samples, 
-                    num_chains=self.num_chains)
-        model.run(random.PRNGKey(0), 
-                 condition_data, 
-                 condition_missing,
-                 self.priors,
-                 self.root_nodes, 
-                 self.descendent_nodes)
+
+        model = partial(NumpyroProteomicPerturbationModel, 
+                        root_nodes=self.root_nodes, 
+                        downstream_nodes=self.descendent_nodes)
+        return model, {"data": condition_data, 
+                       "missing": condition_missing, 
+                       "priors": self.priors}
+
+    def mcmc_cache_key(self):
+
+        """
+        Key identifying MCMC runs that can share one compiled sampler. Fits 
+        with the same graph, number of observations and sampler settings map 
+        to the same key, the imputation sites have a fixed shape so the 
+        missingness pattern itself can differ.
+        """
+
+        return (self.vectorized,
+                None if self.splines is None else 
+                (tuple(self.splines["names"]), 
+                 self.splines["knots"].tobytes()),
+                None if self.detection is None else 
+                tuple(sorted(self.detection.items())),
+                tuple(self.root_nodes),
+                tuple((key, tuple(value)) 
+                      for key, value in self.descendent_nodes.items()),
+                len(self.input_data),
+                self.warmup_steps,
+                self.num_samples,
+                self.num_chains,
+                self.get_chain_method())
+
+    def get_chain_method(self):
+
+        """
+        Resolve how MCMC chains are run. With "auto" chains run in parallel 
+        when there is a host device per chain and vectorized otherwise. 
+        Without a device per chain "parallel" falls back to sequential 
+        chains, as numpyro's MCMC does.
+        """
+
+        if self.chain_method not in ["auto", "parallel", 
+                                     "vectorized", "sequential"]:
+            raise ValueError(f"Unknown chain_method {self.chain_method}")
+
+        enough_devices = jax.local_device_count() >= self.num_chains
+        if self.chain_method == "auto":
+            return "parallel" if enough_devices else "vectorized"
+        if self.chain_method == "parallel" and not enough_devices:
+            return "sequential"
+        return self.chain_method
+
+    def numpyro_latent_sites(self, numpyro_model, model_kwargs):
+
+        """
+        Trace the numpyro model once and return its latent sample sites.
+        """
+
+        trace = numpyro.handlers.trace(
+            numpyro.handlers.seed(numpyro_model, 0)).get_trace(**model_kwargs)
+        return {name: site for name, site in trace.items() 
+                if site["type"] == "sample" and not site["is_observed"]}
+
+    def train_numpyro(self, verbose=True, warm_start=None):
+
+        numpyro_model, model_kwargs = self.prep_numpyro_inputs()
+
+        if warm_start is not None:
+            # Start every chain at the previous posterior means, with the 
+            # previous step size and posterior variances as mass matrix
+            sites = self.numpyro_latent_sites(numpyro_model, model_kwargs)
+            shapes = {name: jnp.shape(site["value"]) 
+                      for name, site in sites.items()}
+            init_values = pad_run_sites(warm_start["values"], shapes)
+            variances = pad_run_sites(warm_start["variances"], shapes, 1.)
+            inverse_mass_matrix = jnp.concatenate(
+                [jnp.ravel(variances[name]) if name in variances 
+                 else jnp.ones(int(np.prod(shapes[name]))) 
+                 for name in sorted(shapes)])
+            model = MCMC(NUTS(numpyro_model, 
+                              init_strategy=init_to_value(values=init_values), 
+                              step_size=warm_start.get("step_size", 1.), 
+                              inverse_mass_matrix=inverse_mass_matrix), 
+                         num_warmup=warm_start["num_warmup"], 
+                         num_samples=self.num_samples, 
+                         num_chains=self.num_chains,
+                         chain_method=self.get_chain_method(),
+                         progress_bar=verbose)
+            model.run(random.PRNGKey(0), **model_kwargs)
+            self.model = model
+            self.last_state = model.last_state
+            self.samples = model.get_samples(group_by_chain=True)
+            return
+
+        if self.cache_mcmc:
+            # The sampling loop is compiled on the first fit of a key and 
+            # reused as is by later fits, which start warmup from the 
+            # adapted step size and mass matrix of the previous run
+            cache_key = self.mcmc_cache_key()
+            cached = MCMC_CACHE.get(cache_key)
+            if cached is None:
+                sample_fn, state = build_cached_sampler(
+                    numpyro_model, model_kwargs, self.warmup_steps, 
+                    self.num_samples, self.num_chains, 
+                    self.get_chain_method())
+                cached = {"state": state, "sample_fn": sample_fn}
+                MCMC_CACHE[cache_key] = cached
+                while len(MCMC_CACHE) > MCMC_CACHE_SIZE:
+                    MCMC_CACHE.popitem(last=False)
+            else:
+                MCMC_CACHE.move_to_end(cache_key)
+
+            cached["state"], samples = cached["sample_fn"](cached["state"], 
+                                                           model_kwargs)
+            self.model = None
+            self.last_state = cached["state"]
+            self.samples = samples
+            return
+
+        model = MCMC(NUTS(numpyro_model), 
+                     num_warmup=self.warmup_steps, 
+                     num_samples=self.num_samples, 
+                     num_chains=self.num_chains,
+                     chain_method=self.get_chain_method(),
+                     progress_bar=verbose)
+        model.run(random.PRNGKey(0), **model_kwargs)
         self.model = model
+        self.last_state = model.last_state
+        self.samples = model.get_samples(group_by_chain=True)
+
+    def train_numpyro_svi(self, verbose=True, warm_start=None):
+
+        """
+        Fit the numpyro model with stochastic variational inference and draw 
+        posterior samples from the fitted guide.
+        """
+
+        numpyro_model, model_kwargs = self.prep_numpyro_inputs()
+
+        num_steps = self.num_steps
+        guide_kwargs = dict()
+        if warm_start is not None:
+            sites = self.numpyro_latent_sites(numpyro_model, model_kwargs)
+            init_values = pad_run_sites(
+                warm_start["values"], 
+                {name: jnp.shape(site["value"]) 
+                 for name, site in sites.items()})
+            guide_kwargs["init_loc_fn"] = init_to_value(values=init_values)
+            num_steps = warm_start["num_steps"]
+
+        # set up the optimizer
+        lrd = self.gamma ** (1 / num_steps)
+        optim = numpyro.optim.ClippedAdam(
+            step_size=lambda step: self.initial_lr * lrd ** step)
+
+        if self.guide_type not in ["AutoNormal", 
+                                   "AutoLowRankMultivariateNormal", 
+                                   "AutoMultivariateNormal"]:
+            raise ValueError(f"Unknown guide_type {self.guide_type}")
+        guide = getattr(numpyro_autoguide, self.guide_type)(numpyro_model, 
+                                                            **guide_kwargs)
+
+        # setup the inference algorithm
+        svi = NumpyroSVI(numpyro_model, guide, optim, loss=NumpyroTrace_ELBO())
+        svi_state = svi.init(random.PRNGKey(0), **model_kwargs)
+        update = jax.jit(lambda state: svi.update(state, **model_kwargs))
+
+        def step_fn():
+            nonlocal svi_state
+            svi_state, loss = update(svi_state)
+            return loss
+
+        # do gradient steps
+        self.loss_history = run_svi_steps(step_fn, num_steps, 
+                                          self.patience, self.min_delta, 
+                                          self.loss_window, verbose)
+
+        params = svi.get_params(svi_state)
+        self.model = svi
+        self.guide = guide
+        self.svi_params = params
+        samples = guide.sample_posterior(
+            random.PRNGKey(1), params, sample_shape=(self.num_samples,))
+        self.samples = {key: value[None] for key, value in samples.items()}
+
+    def get_samples(self, group_by_chain=False):
+
+        """
+        Posterior samples of the numpyro backends.
+
+        Parameters
+        ----------
+        group_by_chain : bool
+            Whether to keep a leading chain dimension. SVI samples are 
+            stored as a single chain.
+
+        Returns
+        -------
+        dict
+            Posterior samples keyed by site name.
+        """
+
+        if group_by_chain:
+            return self.samples
+
+        return {key: value.reshape((-1,) + value.shape[2:]) 
+                for key, value in self.samples.items()}
+
+    def structural_sites(self):
+
+        """
+        Names of the intercept, coefficient, hinge weight and noise scale 
+        sites. Imputed values and latent node values are not structural, 
+        they are resampled whenever the model is run without data.
+        """
+
+        if self.vectorized:
+            sites = ["intercept", "coef", "scale"]
+            if self.splines is not None:
+                sites.append("spline_coef")
+            return sites
+
+        return ([f"{node}_int" for node in self.root_nodes] + 
+                [f"{node}_intercept" for node in self.descendent_nodes] + 
+                [f"{node}_scale" for node in self.root_nodes + 
+                 list(self.descendent_nodes)] + 
+                list(self.structure["edge_names"]))
+
+    def structural_samples(self, num_samples=None):
 
+        """
+        Flattened posterior samples of the structural sites only.
+
+        Parameters
+        ----------
+        num_samples : int
+            Number of evenly spaced draws to keep. All draws are kept if 
+            None.
 
-    def train_pyro(self, verbose=True):
+        Returns
+        -------
+        dict
+            Posterior samples keyed by site name.
+        """
+
+        sites = self.get_samples(group_by_chain=True)
+        samples = {name: sites[name].reshape((-1,) + sites[name].shape[2:]) 
+                   for name in self.structural_sites() if name in sites}
+
+        total = next(iter(samples.values())).shape[0]
+        if num_samples is not None and num_samples < total:
+            index = np.linspace(0, total - 1, num_samples).round().astype(int)
+            samples = {key: value[index] for key, value in samples.items()}
+
+        return samples
+
+    def train_pyro(self, verbose=True, warm_start=None):
         
         pyro.set_rng_seed(1234)
 
-        model = ProteomicPerturbationModel(n_obs = len(self.input_data), 
-                                       root_nodes = self.root_nodes, 
-                                       downstream_nodes = self.descendent_nodes)
-        # dpc_slope = calc_dpc(self.input_data)
-        # self.dpc_slope = dpc_slope
-        condition_data = prep_data_for_model(self.root_nodes, 
-                                             self.descendent_nodes,
-                                             self.input_data,
-                                             self.input_missing)
-        
+        if self.batch_size is not None and not self.vectorized:
+            raise ValueError("Minibatch SVI (batch_size) requires the "
+                             "vectorized model, set vectorized=True.")
+
+        if self.vectorized:
+            n_obs = len(self.input_data)
+            model = VectorizedProteomicPerturbationModel(
+                n_obs=n_obs, structure=self.structure, splines=self.splines)
+            data, missing = prep_matrix_data_for_model(self.structure, 
+                                                       self.input_data, 
+                                                       self.input_missing)
+            self.prior_arrays = self.prior_store.arrays(self.structure)
+            data = torch.tensor(data).float()
+            missing = torch.tensor(missing)
+            priors = {key: torch.tensor(value).float() 
+                      for key, value in self.prior_arrays.items()}
+            model_args = (data, missing, priors)
+
+            # Imputation latents are local to the observation plate, the 
+            # guide keeps one value per run and updates the batch in each step
+            create_plates = lambda data=None, missing=None, priors=None, \
+                subsample=None, **kwargs: pyro.plate("observations", n_obs, 
+                                                     subsample=subsample)
+            guide_kwargs = {"create_plates": create_plates}
+            if self.batch_size is not None:
+                batches = iterate_minibatches(data, missing, self.batch_size)
+        else:
+            model = ProteomicPerturbationModel(n_obs = len(self.input_data), 
+                                           root_nodes = self.root_nodes, 
+                                           downstream_nodes = self.descendent_nodes)
+            # dpc_slope = calc_dpc(self.input_data)
+            # self.dpc_slope = dpc_slope
+            condition_data = prep_data_for_model(self.root_nodes, 
+                                                 self.descendent_nodes,
+                                                 self.input_data,
+                                                 self.input_missing)
+            model_args = (condition_data, self.priors)
+            guide_kwargs = dict()
+
+        num_steps = self.num_steps
+        if warm_start is not None:
+            # Parameters of the previous fit have the old number of runs
+            pyro.clear_param_store()
+            trace = poutine.trace(model).get_trace(*model_args)
+            init_values = pad_run_sites(
+                warm_start["values"], 
+                {name: site["value"].shape for name, site in trace.nodes.items()
+                 if site["type"] == "sample" and not site["is_observed"]})
+            guide_kwargs["init_loc_fn"] = pyro_init_to_value(
+                values={key: torch.tensor(value).float() 
+                        for key, value in init_values.items()})
+            num_steps = warm_start["num_steps"]
+        guide = AutoDelta(model, **guide_kwargs)
 
         # set up the optimizer
-        lrd = self.gamma ** (1 / self.num_steps)
+        lrd = self.gamma ** (1 / num_steps)
         optim = pyro.optim.ClippedAdam({'lr': self.initial_lr, 
                                         'lrd': lrd})
 
-        guide = AutoDelta(model)
-
         # setup the inference algorithm
-        svi = SVI(model, guide, optim, loss=Trace_ELBO())
+        elbo = {"Trace_ELBO": Trace_ELBO, 
+                "JitTrace_ELBO": JitTrace_ELBO, 
+                "JitTraceMeanField_ELBO": CachedJitTraceMeanField_ELBO}
+        if self.elbo not in elbo:
+            raise ValueError(f"Unknown elbo {self.elbo}")
+        svi = SVI(model, guide, optim, loss=elbo[self.elbo]())
+
+        def step_fn():
+            if self.batch_size is not None:
+                index, batch_data, batch_missing = next(batches)
+                # Positional, compiled ELBOs are traced once per kwargs
+                return svi.step(batch_data, batch_missing, priors, index)
+            return svi.step(*model_args)
 
         # do gradient steps
-        best_loss = float('inf')
-        steps_since_improvement = 0
-
-        for step in range(self.num_steps):
-            loss = svi.step(condition_data, self.priors)
-            if step % 100 == 0 & verbose:
-                print(f"Step {step}: Loss = {loss}")
-
-            # Check for improvement
-            if loss < best_loss - self.min_delta:
-                best_loss = loss
-                steps_since_improvement = 0
-            else:
-                steps_since_improvement += 1
-
-            # Early stopping condition
-            if steps_since_improvement >= self.patience:
-                print(f"Stopping early at step {step} with loss {loss}")
-                break
+        self.loss_history = run_svi_steps(step_fn, num_steps, 
+                                          self.patience, self.min_delta, 
+                                          self.loss_window, verbose)
 
         self.model = model
         self.guide = guide
 
-    def add_imputed_values(self):
+    def add_imputed_values(self, long_format=True):
+
         """
         Adds imputed values back into data with mean and scale.
+
+        The posterior imputation means and scales are scattered into wide 
+        (runs x proteins) arrays, `imputed_mean` and `imputed_scale`, which 
+        are NaN wherever a value was observed.
+
+        Parameters
+        ----------
+        long_format : bool
+            Whether to also build the long format `imputed_data` table.
         """
-        
-        # Put data into long format
-        long_data = pd.melt(self.input_data, var_name="protein", 
-                            value_name="intensity")
-        long_data.loc[long_data["intensity"] == 0, "intensity"] = np.nan
-        long_data['was_missing'] = long_data['intensity'].isna()
-        long_data.loc[:, "imp_mean"] = np.nan
-        
+
+        columns = list(self.input_data.columns)
+        intensity = self.input_data.to_numpy(dtype=float, copy=True)
+        intensity[intensity == 0] = np.nan
+        was_missing = np.isnan(intensity)
+
         if self.backend == "pyro":
+            # Imputation sites are only in the param store, without scales
+            means = {key.replace("AutoDelta.imp_", ""): value.numpy() 
+                     for key, value in self.original_params.items() 
+                     if "imp" in key}
+            scales = dict()
+        elif self.detection is not None:
+            means, scales = self.censored_imputation()
+        elif self.backend in ["numpyro", "numpyro_svi"]:
+            means = {key.replace("imp_", ""): value 
+                     for key, value in self.learned_params.items() 
+                     if "imp" in key and not key.endswith("_scale")}
+            scales = {key.replace("imp_", "")[:-len("_scale")]: value 
+                      for key, value in self.learned_params.items() 
+                      if "imp" in key and key.endswith("_scale")}
+
+        # Imputation sites have one entry per run, keep the missing runs
+        imputed_mean = np.full(intensity.shape, np.nan)
+        imputed_scale = np.full(intensity.shape, np.nan)
+        for values, imputed in [(means, imputed_mean), 
+                                (scales, imputed_scale)]:
+            index = [columns.index(i) for i in values if i in columns]
+            if len(index) > 0:
+                imputed[:, index] = np.column_stack(
+                    [np.asarray(values[columns[i]], dtype=float) 
+                     for i in index])
+        imputed_mean[~was_missing] = np.nan
+        imputed_scale[~was_missing] = np.nan
+
+        self.imputed_mean = imputed_mean
+        self.imputed_scale = imputed_scale
+        self.was_missing = was_missing
+
+        if long_format:
+            self.imputed_data = self.imputed_long_format()
+
+    def censored_imputation(self):
 
-            # TODO: (?) Put this into a function to stop code repeat
-            loc_params = [i for i in self.original_params.keys() if ("imp" in i)]
-            loc_imp = pd.DataFrame().from_dict(
-                {key.replace("AutoDelta.imp_", ""): self.original_params[key] \
-                for key in loc_params})
-            loc_imp = loc_imp[self.input_missing.astype(bool)]
-            loc_imp = pd.melt(loc_imp, var_name="protein", 
-                                value_name="imp_loc")
-            loc_imp = loc_imp.dropna(ignore_index=True)
-
-            for col in loc_imp["protein"].unique():
-
-                long_data.loc[(long_data["protein"] == col) & \
-                            (long_data["intensity"].isna()), "imp_mean"] = \
-                                loc_imp.loc[loc_imp["protein"] == col, 
-                                            "imp_loc"].values
-                
-            self.imputed_data = long_data
-        
-        elif self.backend == "numpyro":
+        """
+        Means and scales of the missing values under the MNAR likelihood, 
+        conditioned on non-detection at the posterior mean of the structural 
+        parameters and latent node values.
 
-            # Extract imputation info from model parameters
-            loc_params = [i for i in self.learned_params.keys() if ("imp" in i)]
-            loc_params = {key.replace("imp_", ""): self.learned_params[key] \
-                    for key in loc_params}
+        Returns
+        -------
+        means : dict
+            (Runs,) conditional means of each observed node.
+        scales : dict
+            (Runs,) conditional standard deviations of each observed node.
+        """
 
-            for variable, values in loc_params.items():
-                mask = (long_data['protein'] == variable) & long_data['was_missing']
-                if sum(mask) > 0:
-                    na_indices = long_data[mask].index  # Get the indices for missing values in each variable
-                    fill_len = min(len(values), len(na_indices))  # Determine how many values to use
-                    long_data.loc[na_indices[:fill_len], 'imp_mean'] = values[:fill_len]
+        params = {key: np.asarray(value).mean(axis=0) 
+                  for key, value in self.structural_samples().items()}
+        n_nodes = len(self.structure["nodes"])
+        weights = jnp.zeros((n_nodes, n_nodes)).at[
+            self.structure["edge_parent"], self.structure["edge_child"]
+            ].set(params["coef"])
+
+        data, missing = prep_matrix_data_for_model(self.structure, 
+                                                   self.input_data, 
+                                                   self.input_missing)
+        latent = np.flatnonzero(self.structure["latent"])
+        if len(latent) > 0:
+            data[:, latent] = streaming_moments(
+                {"latent": self.get_samples(group_by_chain=True)["latent"]}, 
+                self.summary_chunk_size)["latent"]["mean"]
+            missing[:, latent] = False
+        _, values, variances = propagate_censored_moments(
+            data, missing, params["intercept"], weights, params["scale"], 
+            self.structure, self.detection)
+
+        nodes = [(node, i) for node, i in self.structure["index"].items() 
+                 if not self.structure["latent"][i]]
+        means = {node: np.asarray(values[:, i]) for node, i in nodes}
+        scales = {node: np.sqrt(np.asarray(variances[:, i])) 
+                  for node, i in nodes}
+
+        return means, scales
+
+    def imputed_long_format(self):
 
-            self.imputed_data = long_data
+        """
+        Long format table of the data and imputed values, in the row order 
+        of `pd.melt` (protein major, runs minor).
+
+        Returns
+        -------
+        pd.DataFrame
+            Table with columns protein, intensity, was_missing and imp_mean.
+        """
+
+        n_runs, n_proteins = self.was_missing.shape
+        intensity = self.input_data.to_numpy(dtype=float, copy=True)
+        intensity[intensity == 0] = np.nan
+
+        return pd.DataFrame({
+            "protein": np.repeat(
+                np.array(self.input_data.columns, dtype=object), n_runs),
+            "intensity": intensity.ravel(order="F"),
+            "was_missing": self.was_missing.ravel(order="F"),
+            "imp_mean": self.imputed_mean.ravel(order="F")})
 
     def fit(self, 
             observational_data, 
@@ -402,21 +1133,360 @@ class LVM:
         self.parse_graph()
         self.parse_data()
         self.parse_priors()
+        self.parse_splines()
+        self.parse_missing_model()
+
+        self.train(verbose=verbose)
+
+    def fit_many(self, datasets, causal_graph, verbose=True):
+
+        """
+        Fit the numpyro model to many datasets with the same graph in one 
+        compiled program. The chains of every dataset are vectorized 
+        together, so all datasets need the same number of runs.
+
+        Parameters
+        ----------
+        datasets : list
+            Observational datasets in the wide format of `fit`.
+        causal_graph : y0.graph.NxMixedGraph
+            The causal graph shared by every dataset.
+        verbose : bool
+            Whether to print progress.
+
+        Returns
+        -------
+        list
+            A fitted LVM per dataset, with the settings of this LVM.
+        """
+
+        if self.backend != "numpyro":
+            raise ValueError("fit_many is only available for the numpyro "
+                             "backend.")
+
+        fits = list()
+        for data in datasets:
+            lvm = LVM(informative_priors=self.informative_priors, 
+                      **{key: getattr(self, key) for key in SAVED_SETTINGS})
+            lvm.obs_data = data
+            lvm.causal_graph = causal_graph
+            lvm.parse_graph()
+            lvm.parse_data()
+            lvm.parse_priors()
+            lvm.parse_splines()
+            lvm.parse_missing_model()
+            fits.append(lvm)
+
+        if len(set(len(lvm.input_data) for lvm in fits)) > 1:
+            raise ValueError("fit_many needs datasets with the same number "
+                             "of runs.")
+
+        if fits[0].splines is not None:
+            # Knots from the runs of all datasets, so every dataset shares 
+            # one compiled model
+            matrices = [prep_matrix_data_for_model(lvm.structure, 
+                                                   lvm.input_data, 
+                                                   lvm.input_missing) 
+                        for lvm in fits]
+            splines = build_spline_basis(
+                fits[0].structure, 
+                np.concatenate([data for data, _ in matrices]), 
+                np.concatenate([missing for _, missing in matrices]), 
+                self.spline_edges, self.n_knots)
+            for lvm in fits:
+                lvm.splines = splines
+
+        if fits[0].detection is not None:
+            detection = calc_probit_detection(
+                pd.concat([lvm.input_data for lvm in fits]))
+            for lvm in fits:
+                lvm.detection = detection
+
+        inputs = [lvm.prep_numpyro_inputs() for lvm in fits]
+        numpyro_model, model_kwargs = inputs[0]
+        shared_kwargs = {"priors": model_kwargs["priors"]}
+        batched_kwargs = jax.tree.map(
+            lambda *values: jnp.stack(values), 
+            *[{"data": kwargs["data"], "missing": kwargs["missing"]} 
+              for _, kwargs in inputs])
+
+        if verbose:
+            print(f"Sampling {len(fits)} datasets x {self.num_chains} chains")
+        sample_fn = build_batched_sampler(numpyro_model, shared_kwargs, 
+                                          batched_kwargs, self.warmup_steps, 
+                                          self.num_samples, self.num_chains, 
+                                          self.get_chain_method())
+        samples = sample_fn(random.PRNGKey(0), batched_kwargs)
+
+        for i, lvm in enumerate(fits):
+            lvm.samples = {key: value[i] for key, value in samples.items()}
+            lvm.compile_numpyro_parameters()
+            lvm.add_imputed_values()
+
+        return fits
+
+    def train(self, verbose=True, warm_start=None):
+
+        """
+        Train the model on the parsed data and extract results.
+
+        Parameters
+        ----------
+        verbose : bool
+            Whether to print progress.
+        warm_start : dict
+            Optional initialization from a previous fit, see `update`.
+        """
 
-        # Train model and extract results
         if self.backend == "numpyro":
-            self.train_numpyro(verbose=verbose)
+            self.train_numpyro(verbose=verbose, warm_start=warm_start)
+            self.compile_numpyro_parameters()
+        elif self.backend == "numpyro_svi":
+            self.train_numpyro_svi(verbose=verbose, warm_start=warm_start)
             self.compile_numpyro_parameters()
         elif self.backend == "pyro":
-            self.train_pyro(verbose=verbose)
+            self.train_pyro(verbose=verbose, warm_start=warm_start)
             self.compile_pyro_parameters()
             
         self.add_imputed_values()
 
-    def intervention(self, intervention, outcome_node, compare_value=0.):
-        
-        # Prep interventional conditioning data
+    def warm_start_values(self):
+
+        """
+        Summary of the current posterior used to initialize a refit: the 
+        posterior means of every site and, for MCMC, the posterior 
+        variances in unconstrained space and the adapted step size.
+
+        Returns
+        -------
+        dict
+            Warm start values keyed by `values`, `variances` and `step_size`.
+        """
+
         if self.backend == "pyro":
+            return {"values": {key: value.detach().numpy() 
+                               for key, value in self.guide.median().items()}}
+
+        samples = self.get_samples(group_by_chain=True)
+        moments = streaming_moments(samples, self.summary_chunk_size)
+        warm_start = {"values": {key: value["mean"] 
+                                 for key, value in moments.items()}}
+
+        if self.backend == "numpyro":
+            sites = self.numpyro_latent_sites(*self.prep_numpyro_inputs())
+            unconstrained = {
+                name: biject_to(site["fn"].support).inv(samples[name]) 
+                for name, site in sites.items() if name in samples}
+            warm_start["variances"] = {
+                key: np.maximum(value["std"]**2, 1e-6) for key, value 
+                in streaming_moments(unconstrained, 
+                                     self.summary_chunk_size).items()}
+            if getattr(self, "last_state", None) is not None:
+                warm_start["step_size"] = float(
+                    np.mean(self.last_state.adapt_state.step_size))
+
+        return warm_start
+
+    def update(self, 
+               new_observational_data, 
+               warmup_steps=None, 
+               num_steps=None, 
+               verbose=True):
+
+        """
+        Refit the model after new runs are added to the study. The sampler 
+        or guide starts from the current posterior, so only a short 
+        adaptation is run instead of a full fit.
+
+        Parameters
+        ----------
+        new_observational_data : pd.DataFrame
+            The new runs, in the same wide format as the data of `fit`.
+        warmup_steps : int
+            MCMC warmup steps of the refit, defaults to a fifth of 
+            `warmup_steps`.
+        num_steps : int
+            SVI steps of the refit, defaults to a fifth of `num_steps`.
+        verbose : bool
+            Whether to print progress.
+        """
+
+        warm_start = self.warm_start_values()
+        warm_start["num_warmup"] = warmup_steps if warmup_steps is not None \
+            else max(self.warmup_steps // 5, 1)
+        warm_start["num_steps"] = num_steps if num_steps is not None \
+            else max(self.num_steps // 5, 1)
+
+        self.obs_data = pd.concat(
+            [self.obs_data, 
+             new_observational_data.reindex(columns=self.obs_data.columns)])
+        self.parse_data()
+
+        self.train(verbose=verbose, warm_start=warm_start)
+
+    def save(self, path, drop_imputation=False, imputation_thinning=1):
+
+        """
+        Save a fitted numpyro LVM to a directory. Every posterior site is 
+        written to its own `.npy` file, so `load` can memory-map the samples. 
+        Samples saved to the directory before are replaced.
+
+        Only scalar `learned_params` are saved and `summary_stats` are not, 
+        so a loaded model does not restore the imputation means and scales 
+        and `add_imputed_values` does not work on it.
+
+        Parameters
+        ----------
+        path : str
+            Directory to write to, created if it does not exist.
+        drop_imputation : bool
+            Whether to leave out the imputation sites.
+        imputation_thinning : int
+            Keep every n-th draw of the imputation sites.
+        """
+
+        if self.backend not in ["numpyro", "numpyro_svi"]:
+            raise ValueError("save is only available for numpyro backends")
+
+        # Samples are written to a fresh directory that replaces the old 
+        # one, the current samples may be memory-mapped from it
+        sample_dir = os.path.join(path, "samples")
+        tmp_dir = os.path.join(path, "samples.tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for site, value in self.get_samples(group_by_chain=True).items():
+            if site.startswith("imp"):
+                if drop_imputation:
+                    continue
+                value = value[:, ::imputation_thinning]
+            np.save(os.path.join(tmp_dir, f"{site}.npy"), np.asarray(value))
+
+        shutil.rmtree(sample_dir, ignore_errors=True)
+        os.replace(tmp_dir, sample_dir)
+
+        np.save(os.path.join(path, "data.npy"), 
+                np.asarray(self.obs_data.to_numpy(), dtype=float))
+
+        learned_params = {key: value for key, value 
+                          in self.learned_params.items() 
+                          if np.ndim(value) == 0}
+        metadata = {
+            "settings": {key: getattr(self, key) for key in SAVED_SETTINGS},
+            "columns": [str(i) for i in self.obs_data.columns],
+            "root_nodes": self.root_nodes,
+            "descendent_nodes": self.descendent_nodes,
+            "priors": self.priors,
+            "learned_params": learned_params,
+            "splines": None if self.splines is None else {
+                key: value if key == "names" else np.asarray(value).tolist() 
+                for key, value in self.splines.items()},
+            "detection": self.detection}
+
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump(metadata, f, default=float)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+
+        """
+        Load an LVM written by `save`. Posterior samples are memory-mapped, 
+        so intervention queries can run without keeping them resident.
+
+        Parameters
+        ----------
+        path : str
+            Directory written by `save`.
+        mmap_mode : str
+            Passed to `numpy.load`, None reads the samples into memory.
+
+        Returns
+        -------
+        LVM
+            The fitted model.
+        """
+
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+
+        lvm = cls(**metadata["settings"])
+        lvm.obs_data = pd.DataFrame(np.load(os.path.join(path, "data.npy")), 
+                                    columns=metadata["columns"])
+        lvm.root_nodes = metadata["root_nodes"]
+        lvm.descendent_nodes = metadata["descendent_nodes"]
+        lvm.structure = build_model_structure(lvm.root_nodes, 
+                                              lvm.descendent_nodes)
+        lvm.prior_store = PriorStore(metadata["priors"])
+        lvm.priors = lvm.prior_store.node_priors(lvm.root_nodes, 
+                                                 lvm.descendent_nodes)
+        lvm.prior_arrays = lvm.prior_store.arrays(lvm.structure)
+        lvm.learned_params = metadata["learned_params"]
+        lvm.parse_data()
+        # The knots of the fit are restored, they may differ from the knots 
+        # of the saved data after update or fit_many
+        lvm.splines = metadata.get("splines")
+        if lvm.splines is not None:
+            lvm.splines = {key: value if key == "names" else 
+                           np.asarray(value, dtype=int if key == "parent" 
+                                      else float) 
+                           for key, value in lvm.splines.items()}
+        # The detection model of the fit is restored instead of refit
+        lvm.detection = metadata.get("detection")
+
+        sample_dir = os.path.join(path, "samples")
+        lvm.samples = {
+            site[:-len(".npy")]: np.load(os.path.join(sample_dir, site), 
+                                         mmap_mode=mmap_mode)
+            for site in sorted(os.listdir(sample_dir)) if site.endswith(".npy")}
+
+        return lvm
+
+    def intervention(self, intervention, outcome_node, compare_value=0.,
+                     num_samples=None, batch_size=None):
+
+        """
+        Posterior predictive samples of `outcome_node` under an intervention 
+        and under a baseline intervention, stored as `intervention_samples` 
+        and `posterior_samples`.
+
+        Parameters
+        ----------
+        intervention : dict
+            Mapping of node names to intervention values.
+        outcome_node : str
+            Node to return samples of.
+        compare_value : float
+            Value of the baseline intervention.
+        num_samples : int
+            Number of evenly spaced posterior draws to predict from, numpyro 
+            backends only. All draws are used if None.
+        batch_size : int
+            Number of posterior draws predicted at once, numpyro backends 
+            only. All draws are predicted at once if None.
+        """
+
+        # Prep interventional conditioning data
+        if self.backend == "pyro" and self.vectorized:
+            priors = {key: torch.tensor(value).float() 
+                      for key, value in self.prior_arrays.items()}
+            # AutoDelta has a single posterior point, repeated per sample
+            posterior = {key: value.detach().expand((500,) + value.shape) 
+                         for key, value in self.guide.median().items() 
+                         if key != "imp"}
+            ate_predictive = pyro.infer.Predictive(
+                self.model, posterior_samples=posterior, 
+                return_sites=[outcome_node])
+            zero_int = {key: compare_value for key in intervention.keys()}
+
+            zero_int = ate_predictive(None, None, priors, 
+                                      intervention=zero_int)
+            intervention = ate_predictive(None, None, priors, 
+                                          intervention=intervention)
+
+            self.posterior_samples = zero_int[outcome_node].flatten()
+            self.intervention_samples = intervention[outcome_node].flatten()
+
+        elif self.backend == "pyro":
             condition_data_test = dict()
             for node in self.root_nodes:
                 if "latent" not in node:
@@ -451,42 +1521,243 @@ class LVM:
             self.posterior_samples = zero_int[outcome_node].flatten()
             self.intervention_samples = intervention[outcome_node].flatten()
         
-        elif self.backend == "numpyro":
+        elif self.backend in ["numpyro", "numpyro_svi"]:
             rng_key, rng_key_ = random.split(random.PRNGKey(2))
 
-            if len(intervention) > 1:
-                nodes = list(intervention.keys())
-                zero_model = numpyro.handlers.do(
-                    NumpyroProteomicPerturbationModel, 
-                    data={nodes[0]: compare_value,
-                          nodes[1]: compare_value})
-            else:
-                zero_model = numpyro.handlers.do(
-                    NumpyroProteomicPerturbationModel, 
-                    data={next(iter(intervention)): compare_value})
-            zero_predictive = Predictive(zero_model, self.model.get_samples())
-            zero_predictions = zero_predictive(rng_key_, None, [],
-                                               self.priors,
-                                               self.root_nodes,
-                                               self.descendent_nodes)
-
-            int_model = numpyro.handlers.do(
-                NumpyroProteomicPerturbationModel, 
-                data=intervention)
-            int_predictive = Predictive(int_model, self.model.get_samples())
-            int_predictions = int_predictive(rng_key_, None, [],
-                                             self.priors,
-                                             self.root_nodes,
-                                             self.descendent_nodes)
-            
-            zero_predictions = zero_predictions[outcome_node]
-            int_predictions = int_predictions[outcome_node]
+            samples = self.structural_samples(num_samples)
+            zero_int = {key: compare_value for key in intervention.keys()}
+            zero_predictions = self.predict_numpyro(
+                zero_int, rng_key_, samples, return_sites=[outcome_node],
+                batch_size=batch_size)
+            int_predictions = self.predict_numpyro(
+                intervention, rng_key_, samples, return_sites=[outcome_node],
+                batch_size=batch_size)
             
-            self.posterior_samples = zero_predictions
-            self.intervention_samples = int_predictions
+            self.posterior_samples = zero_predictions[outcome_node]
+            self.intervention_samples = int_predictions[outcome_node]
+
+    def predict_numpyro(self, intervention, rng_key, samples, 
+                        return_sites=None, batch_size=None):
+
+        """
+        Sample all nodes of the numpyro model under an intervention.
+
+        Parameters
+        ----------
+        intervention : dict
+            Mapping of node names to intervention values.
+        rng_key : jax.random.PRNGKey
+            Random key for the predictive draws.
+        samples : dict
+            Posterior samples to draw the structural parameters from.
+        return_sites : list
+            Sites to return. Every sampled and deterministic site is 
+            returned if None.
+        batch_size : int
+            Number of posterior samples predicted at once. All samples are 
+            predicted at once if None.
+
+        Returns
+        -------
+        dict
+            Predicted values of every node, one per posterior sample.
+        """
+
+        if self.vectorized:
+            model = NumpyroVectorizedPerturbationModel
+            model_args = (None, None, self.prior_arrays, self.structure, 
+                          intervention, self.splines)
+        else:
+            model = numpyro.handlers.do(NumpyroProteomicPerturbationModel, 
+                                        data=intervention)
+            model_args = (None, [], self.priors, self.root_nodes, 
+                          self.descendent_nodes)
+
+        total = next(iter(samples.values())).shape[0]
+        if batch_size is None or batch_size >= total:
+            predictive = Predictive(model, samples, return_sites=return_sites)
+            return predictive(rng_key, *model_args)
+
+        predictions = list()
+        for start in range(0, total, batch_size):
+            batch = {key: value[start:start + batch_size] 
+                     for key, value in samples.items()}
+            predictive = Predictive(model, batch, return_sites=return_sites)
+            predictions.append(predictive(random.fold_in(rng_key, start), 
+                                          *model_args))
+
+        return {key: jnp.concatenate([batch[key] for batch in predictions]) 
+                for key in predictions[0]}
+
+    def intervention_grid(self, nodes, values, outcomes, compare_value=0.,
+                          num_samples=None):
+
+        """
+        Evaluate a grid of interventions in one vectorized pass.
+
+        The do-handled model is vmapped over the rows of `values`, and the 
+        baseline where all `nodes` are set to `compare_value` is computed 
+        once. Every grid point uses the same random key, so differences 
+        between grid points are not blurred by sampling noise.
+
+        Parameters
+        ----------
+        nodes : list
+            Nodes that are intervened on.
+        values : array-like
+            Intervention values of shape (Grid,) for a single node or 
+            (Grid x Nodes).
+        outcomes : list
+            Outcome nodes to return.
+        compare_value : float
+            Value of the baseline intervention.
+        num_samples : int
+            Number of evenly spaced posterior draws to predict from. All 
+            draws are used if None.
+
+        Returns
+        -------
+        grid_samples : np.ndarray
+            (Grid x Samples x Outcomes) posterior samples of the outcomes.
+        baseline_samples : np.ndarray
+            (Samples x Outcomes) posterior samples under the baseline.
+        """
+
+        if self.backend not in ["numpyro", "numpyro_svi"]:
+            raise ValueError(
+                "intervention_grid is only available for numpyro backends")
+
+        values = jnp.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, None]
+        if values.shape[1] != len(nodes):
+            raise ValueError("values must have one column per node")
+
+        rng_key, rng_key_ = random.split(random.PRNGKey(2))
+        samples = self.structural_samples(num_samples)
+
+        def predict(value):
+            intervention = {node: value[i] for i, node in enumerate(nodes)}
+            predictions = self.predict_numpyro(intervention, rng_key_, 
+                                               samples, return_sites=outcomes)
+            return jnp.stack([predictions[i] for i in outcomes], axis=-1)
+
+        baseline_samples = predict(jnp.full(len(nodes), compare_value))
+        grid_samples = jax.vmap(predict)(values)
+
+        self.grid_samples = np.asarray(grid_samples)
+        self.grid_baseline_samples = np.asarray(baseline_samples)
+
+        return self.grid_samples, self.grid_baseline_samples
+
+    def coefficient_samples(self):
+
+        """
+        Posterior samples of the edge coefficients as one (Samples x Edges) 
+        array, ordered like `self.structure["edge_names"]`.
+        """
+
+        samples = self.structural_samples()
+        if self.vectorized:
+            return samples["coef"]
+
+        if len(self.structure["edge_names"]) == 0:
+            n_samples = next(iter(samples.values())).shape[0]
+            return jnp.zeros((n_samples, 0))
+
+        return jnp.stack([samples[name] 
+                          for name in self.structure["edge_names"]], axis=-1)
+
+    def linear_effects(self, intervention_nodes=None, num_samples=None):
+
+        """
+        Closed form total effects of the linear-Gaussian SCM.
+
+        For each posterior draw the coefficient matrix B is built and 
+        (I - B)^-1 is solved, whose (i, j) entry is the sum over all directed 
+        paths from i to j of the product of the coefficients. Incoming edges 
+        of `intervention_nodes` are cut first, so the effects are those of a 
+        joint intervention on these nodes.
+
+        Parameters
+        ----------
+        intervention_nodes : list
+            Nodes that are jointly intervened on. If None the effect of each 
+            node is computed on its own.
+        num_samples : int
+            Optional number of posterior draws to thin to.
+
+        Returns
+        -------
+        np.ndarray
+            (Samples x Nodes x Nodes) tensor of total effects, ordered like 
+            `self.structure["nodes"]`.
+        """
+
+        if self.backend not in ["numpyro", "numpyro_svi"]:
+            raise ValueError(
+                "linear_effects is only available for numpyro backends")
+        if self.splines is not None:
+            raise ValueError("linear_effects assumes linear edges, use "
+                             "intervention for models with spline edges")
+
+        coef = self.coefficient_samples()
+        if num_samples is not None:
+            coef = coef[::max(coef.shape[0] // num_samples, 1)][:num_samples]
+
+        n_nodes = len(self.structure["nodes"])
+        weights = jnp.zeros((coef.shape[0], n_nodes, n_nodes)).at[
+            :, self.structure["edge_parent"], self.structure["edge_child"]
+            ].set(coef)
+
+        if intervention_nodes is not None:
+            cut = [self.structure["index"][i] for i in intervention_nodes]
+            weights = weights.at[:, :, cut].set(0.)
+
+        identity = jnp.eye(n_nodes)
+        effects = jnp.linalg.solve(identity - weights, 
+                                   jnp.broadcast_to(identity, weights.shape))
+
+        return np.asarray(effects)
+
+    def linear_ate(self, intervention, outcome_node, compare_value=0., 
+                   num_samples=None):
+
+        """
+        Closed form posterior samples of the average treatment effect of 
+        `intervention` against setting the same nodes to `compare_value`.
+
+        Parameters
+        ----------
+        intervention : dict
+            Mapping of node names to intervention values.
+        outcome_node : str
+            Node the effect is measured on.
+        compare_value : float
+            Value of the baseline intervention.
+        num_samples : int
+            Optional number of posterior draws to thin to.
+
+        Returns
+        -------
+        np.ndarray
+            Posterior samples of the treatment effect.
+        """
+
+        effects = self.linear_effects(list(intervention.keys()), num_samples)
+        outcome = self.structure["index"][outcome_node]
+
+        ate = 0.
+        for node, value in intervention.items():
+            ate = ate + effects[:, self.structure["index"][node], outcome] * \
+                (value - compare_value)
+
+        return ate
 
 def main():
 
+    configure_devices()
+
     from MScausality.simulation.example_graphs import mediator, signaling_network
     import pickle
 
@@ -1,4 +1,5 @@
 
+import torch
 import pyro
 from pyro.nn import PyroModule
 import pyro.distributions as pyro_dist
@@ -9,6 +10,8 @@ from chirho.interventional.handlers import do
 import numpyro
 import numpyro.distributions as numpyro_dist
 from jax import numpy as jnp
+from jax.scipy.stats import norm
+import numpy as np
 
 class ProteomicPerturbationModel(PyroModule):
     def __init__(self, n_obs, root_nodes, downstream_nodes):
@@ -183,6 +186,147 @@ class ProteomicPerturbationCATE(pyro.nn.PyroModule):
         # with MultiWorldCounterfactual(), do(actions=intervention):
         #     return self.model(data=condition_data)
 
+class VectorizedProteomicPerturbationModel(PyroModule):
+
+    """
+    Matrix form of `ProteomicPerturbationModel`.
+
+    All intercepts and scales are stored in per node vectors and all 
+    coefficients in one edge vector that is scattered into a masked 
+    (Nodes x Nodes) weight matrix. Node values live in a single 
+    (Runs x Nodes) site inside one observation plate, so the cost of a step 
+    does not grow with python overhead per node. Caller tensors are never 
+    modified.
+
+    Parameters
+    ----------
+    n_obs : int
+        Number of runs.
+    structure : dict
+        Graph structure returned by `build_model_structure`.
+    splines : dict
+        Optional basis of piecewise-linear edges returned by 
+        `build_spline_basis`.
+    """
+
+    def __init__(self, n_obs, structure, splines=None):
+
+        super().__init__()
+        self.n_obs = n_obs
+        self.structure = structure
+        self.n_nodes = len(structure["nodes"])
+        self.edge_parent = torch.as_tensor(structure["edge_parent"])
+        self.edge_child = torch.as_tensor(structure["edge_child"])
+        self.splines = None if splines is None else {
+            key: torch.as_tensor(splines[key]).float() 
+            for key in ["knots", "prior_scale", "child_matrix"]}
+        if splines is not None:
+            self.splines["parent"] = torch.as_tensor(splines["parent"])
+
+    def edge_effect(self, values, weights, spline_coef):
+
+        """
+        Effect of the parents on every node, linear plus the hinge terms 
+        of the spline edges.
+        """
+
+        effect = values @ weights
+        if self.splines is not None:
+            hinge = torch.clamp(values[..., self.splines["parent"], None] - 
+                                self.splines["knots"], min=0.)
+            effect = effect + torch.einsum("...sk,sk,sn->...n", hinge, 
+                                           spline_coef, 
+                                           self.splines["child_matrix"])
+        return effect
+
+    def forward(self, data, missing, priors, subsample=None, 
+                intervention=None):
+
+        """
+        Parameters
+        ----------
+        data : torch.Tensor
+            (Runs x Nodes) data matrix, or None to sample from the model.
+        missing : torch.Tensor
+            (Runs x Nodes) boolean missingness mask.
+        priors : dict
+            Prior arrays returned by `PriorStore.arrays`, as tensors.
+        subsample : torch.Tensor
+            Optional indices of the runs in `data` for minibatch SVI, the 
+            likelihood is scaled up to the full number of runs.
+        intervention : dict
+            Optional mapping of node names to fixed values, only used when 
+            sampling from the model.
+        """
+
+        intercept = pyro.sample(
+            "intercept", pyro_dist.Normal(
+                priors["int_loc"], priors["int_scale"]).to_event(1))
+        coef = pyro.sample(
+            "coef", pyro_dist.Normal(
+                priors["coef_loc"], priors["coef_scale"]).to_event(1))
+        scale = pyro.sample(
+            "scale", pyro_dist.Exponential(
+                torch.ones(self.n_nodes)).to_event(1))
+
+        weights = torch.zeros((self.n_nodes, self.n_nodes)).index_put(
+            (self.edge_parent, self.edge_child), coef)
+
+        spline_coef = None
+        if self.splines is not None:
+            spline_coef = pyro.sample(
+                "spline_coef", pyro_dist.Normal(
+                    0., self.splines["prior_scale"]).to_event(2))
+
+        with pyro.plate("observations", self.n_obs, 
+                        subsample=subsample) as index:
+
+            if data is not None:
+
+                # Missing values and latent nodes are filled from one fixed 
+                # shape latent matrix, observed entries get a standard normal
+                missing = missing.bool()
+                imp = pyro.sample(
+                    "imp", pyro_dist.Normal(0., 1.).expand(
+                        [len(index), self.n_nodes]).mask(~missing).to_event(1))
+                values = torch.where(missing, imp, data)
+
+                mean = intercept + self.edge_effect(values, weights, 
+                                                    spline_coef)
+                pyro.sample("observed", 
+                            pyro_dist.Normal(mean, scale).to_event(1), 
+                            obs=values)
+
+            else:
+
+                if intervention is None:
+                    intervention = dict()
+                int_mask = torch.zeros(self.n_nodes, dtype=torch.bool)
+                int_values = torch.zeros(self.n_nodes)
+                for node_name, value in intervention.items():
+                    int_mask[self.structure["index"][node_name]] = True
+                    int_values[self.structure["index"][node_name]] = float(value)
+
+                values = torch.zeros((self.n_obs, self.n_nodes))
+                for i, layer in enumerate(self.structure["layers"]):
+                    layer = torch.as_tensor(layer)
+                    mean = intercept[layer] + self.edge_effect(
+                        values, weights, spline_coef)[:, layer]
+                    layer_sample = pyro.sample(
+                        f"layer_{i}", 
+                        pyro_dist.Normal(mean, scale[layer]).to_event(1))
+                    layer_sample = torch.where(int_mask[layer], 
+                                               int_values[layer], 
+                                               layer_sample)
+                    values = values.clone()
+                    values[:, layer] = layer_sample
+
+                for node_name, i in self.structure["index"].items():
+                    pyro.deterministic(node_name, values[..., i])
+
+        return {node_name: values[..., i] 
+                for node_name, i in self.structure["index"].items()}
+
 def NumpyroProteomicPerturbationModel(data, 
                                       missing,
                                       priors,
@@ -252,16 +396,17 @@ def NumpyroProteomicPerturbationModel(data,
                 )
             else:
 
+                # Fixed length imputation vector so the model shape does 
+                # not depend on the missing count. Entries at observed 
+                # positions are unused and get a standard normal density.
+                node_missing = jnp.asarray(missing[node_name]) == 1
                 imp = numpyro.sample(
-                    f"imp_{node_name}", numpyro_dist.Normal(
-                        root_coef_dict_mean[node_name],
-                        root_coef_dict_scale[node_name]).expand(
-                        [sum(missing[node_name] == 1)]
-                    ).mask(False)
+                    f"imp_{node_name}", numpyro_dist.Normal(0., 1.).expand(
+                        [data[node_name].shape[0]]
+                    ).mask(~node_missing)
                 )
 
-                observed = jnp.asarray(
-                    data[node_name]).at[missing[node_name] == 1].set(imp)
+                observed = jnp.where(node_missing, imp, data[node_name])
 
                 root_sample = numpyro.sample(f"{node_name}",
                                              numpyro_dist.Normal(
@@ -294,14 +439,14 @@ def NumpyroProteomicPerturbationModel(data,
 
         if data is not None:
 
+            node_missing = jnp.asarray(missing[node_name]) == 1
             imp = numpyro.sample(
-                f"imp_{node_name}", numpyro_dist.Normal(
-                    mean[missing[node_name] == 1],
-                    scale).mask(False)
+                f"imp_{node_name}", numpyro_dist.Normal(0., 1.).expand(
+                    [data[node_name].shape[0]]
+                ).mask(~node_missing)
             )
 
-            observed = jnp.asarray(
-                data[node_name]).at[missing[node_name] == 1].set(imp)
+            observed = jnp.where(node_missing, imp, data[node_name])
 
             # Create a Normal distribution object
             downstream_sample = numpyro.sample(f"{node_name}",
@@ -316,3 +461,208 @@ def NumpyroProteomicPerturbationModel(data,
 
     return downstream_distributions
 
+def propagate_censored_moments(data, missing, intercept, weights, scale, 
+                               structure, detection):
+
+    """
+    Integrate out missing values under a probit detection model 
+    P(observed | y) = Phi((y - loc) / scale), one topological layer at a 
+    time.
+
+    Each node is Normal given the mean and variance of its parents. An 
+    observed entry contributes its Normal density, a missing entry the 
+    probability of not being detected, Phi((loc - mean) / sqrt(var + 
+    scale^2)). Missing entries are then passed on to their children with 
+    the mean and variance of the Normal conditioned on non-detection. 
+    Parents are treated as independent and children do not inform the 
+    moments of their parents, so the likelihood is an assumed density 
+    approximation. Latent nodes have no detection model, their values have 
+    to be filled in and marked as observed, so that the covariance a 
+    confounder induces between its children is kept.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (Runs x Nodes) data matrix with missing values set to zero and the 
+        values of latent nodes filled in.
+    missing : np.ndarray
+        (Runs x Nodes) boolean missingness mask, False for latent nodes.
+    intercept : jnp.ndarray
+        Intercept of each node.
+    weights : jnp.ndarray
+        (Nodes x Nodes) coefficient matrix, parents in rows.
+    scale : jnp.ndarray
+        Noise scale of each node.
+    structure : dict
+        Graph structure returned by `build_model_structure`.
+    detection : dict
+        The `loc` and `scale` of the detection model, as returned by 
+        `calc_probit_detection`.
+
+    Returns
+    -------
+    log_lik : jnp.ndarray
+        (Runs x Nodes) log likelihood of each entry.
+    values : jnp.ndarray
+        (Runs x Nodes) data with missing entries replaced by their 
+        conditional means.
+    variances : jnp.ndarray
+        (Runs x Nodes) conditional variances, zero for observed entries.
+    """
+
+    missing = jnp.asarray(missing, dtype=bool)
+    values = jnp.where(missing, 0., data)
+    variances = jnp.zeros(jnp.shape(data))
+    log_lik = jnp.zeros(jnp.shape(data))
+
+    for layer in structure["layers"]:
+        mean = intercept[layer] + values @ weights[:, layer]
+        var = scale[layer]**2 + variances @ weights[:, layer]**2
+        layer_missing = missing[:, layer]
+        layer_data = values[:, layer]
+
+        total_scale = jnp.sqrt(var + detection["scale"]**2)
+        z = (detection["loc"] - mean) / total_scale
+        missing_lik = norm.logcdf(z)
+        # The detection factor of observed entries does not depend on the 
+        # parameters and is left out
+        observed_lik = norm.logpdf(layer_data, mean, jnp.sqrt(var))
+
+        ratio = jnp.exp(norm.logpdf(z) - norm.logcdf(z))
+        cond_mean = mean - var * ratio / total_scale
+        cond_var = jnp.maximum(
+            var - var**2 * ratio * (z + ratio) / total_scale**2, 0.)
+
+        log_lik = log_lik.at[:, layer].set(
+            jnp.where(layer_missing, missing_lik, observed_lik))
+        values = values.at[:, layer].set(
+            jnp.where(layer_missing, cond_mean, layer_data))
+        variances = variances.at[:, layer].set(
+            jnp.where(layer_missing, cond_var, 0.))
+
+    return log_lik, values, variances
+
+def NumpyroVectorizedPerturbationModel(data,
+                                       missing,
+                                       priors,
+                                       structure,
+                                       intervention=None,
+                                       splines=None,
+                                       detection=None):
+
+    """
+    Matrix form of `NumpyroProteomicPerturbationModel`.
+
+    All intercepts and scales are stored in per node vectors and all 
+    coefficients in one edge vector that is scattered into a masked 
+    (Nodes x Nodes) weight matrix. When data is passed the likelihood of every 
+    node is evaluated with a single matmul, otherwise the SCM is simulated 
+    one topological layer at a time.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        (Runs x Nodes) data matrix, or None to sample from the model.
+    missing : np.ndarray
+        (Runs x Nodes) boolean missingness mask.
+    priors : dict
+        Prior arrays returned by `PriorStore.arrays`.
+    structure : dict
+        Graph structure returned by `build_model_structure`.
+    intervention : dict
+        Optional mapping of node names to fixed values, only used when 
+        sampling from the model.
+    splines : dict
+        Optional basis of piecewise-linear edges returned by 
+        `build_spline_basis`. Their hinge terms are added to the linear 
+        effect of the edge.
+    detection : dict
+        Optional probit detection model returned by 
+        `calc_probit_detection`. If passed, missing values are integrated 
+        out with `propagate_censored_moments` instead of being imputed.
+    """
+
+    n_nodes = len(structure["nodes"])
+
+    intercept = numpyro.sample(
+        "intercept", numpyro_dist.Normal(priors["int_loc"], 
+                                         priors["int_scale"]))
+    coef = numpyro.sample(
+        "coef", numpyro_dist.Normal(priors["coef_loc"], 
+                                    priors["coef_scale"]))
+    scale = numpyro.sample(
+        "scale", numpyro_dist.Exponential(1.).expand([n_nodes]))
+
+    weights = jnp.zeros((n_nodes, n_nodes)).at[
+        structure["edge_parent"], structure["edge_child"]].set(coef)
+
+    if splines is not None:
+        spline_coef = numpyro.sample(
+            "spline_coef", numpyro_dist.Normal(0., splines["prior_scale"]))
+
+    def edge_effect(values):
+        effect = values @ weights
+        if splines is not None:
+            hinge = jnp.maximum(
+                values[..., splines["parent"], None] - splines["knots"], 0.)
+            effect = effect + jnp.einsum("...sk,sk,sn->...n", hinge, 
+                                         spline_coef, splines["child_matrix"])
+        return effect
+
+    if data is not None and detection is not None:
+
+        # Latent nodes keep one sampled value per run, their density is the 
+        # Normal likelihood of the node
+        latent = np.flatnonzero(structure["latent"])
+        missing = jnp.asarray(missing, dtype=bool)
+        if len(latent) > 0:
+            latent_values = numpyro.sample(
+                "latent", numpyro_dist.Normal(0., 1.).expand(
+                    [jnp.shape(data)[0], len(latent)]).mask(False))
+            data = jnp.asarray(data).at[:, latent].set(latent_values)
+            missing = missing.at[:, latent].set(False)
+
+        log_lik, values, _ = propagate_censored_moments(
+            data, missing, intercept, weights, scale, structure, detection)
+        numpyro.factor("observed", log_lik.sum())
+
+    elif data is not None:
+
+        # Missing values and latent nodes are filled from one fixed shape 
+        # latent matrix, entries at observed positions get a standard normal
+        missing = jnp.asarray(missing, dtype=bool)
+        imp = numpyro.sample(
+            "imp", numpyro_dist.Normal(0., 1.).expand(
+                jnp.shape(data)).mask(~missing))
+        values = jnp.where(missing, imp, data)
+
+        mean = intercept + edge_effect(values)
+        numpyro.sample("observed", numpyro_dist.Normal(mean, scale), 
+                       obs=values)
+
+    else:
+
+        if intervention is None:
+            intervention = dict()
+        int_mask = np.zeros(n_nodes, dtype=bool)
+        int_values = jnp.zeros(n_nodes)
+        for node_name, value in intervention.items():
+            int_mask[structure["index"][node_name]] = True
+            int_values = int_values.at[
+                structure["index"][node_name]].set(value)
+
+        values = jnp.zeros(n_nodes)
+        for i, layer in enumerate(structure["layers"]):
+            mean = intercept[layer] + edge_effect(values)[layer]
+            layer_sample = numpyro.sample(
+                f"layer_{i}", numpyro_dist.Normal(mean, scale[layer]))
+            layer_sample = jnp.where(int_mask[layer], 
+                                     int_values[layer], 
+                                     layer_sample)
+            values = values.at[layer].set(layer_sample)
+
+        for node_name, i in structure["index"].items():
+            numpyro.deterministic(node_name, values[i])
+
+    return {node_name: values[..., i] 
+            for node_name, i in structure["index"].items()}
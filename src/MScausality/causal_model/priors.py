@@ -0,0 +1,216 @@
+
+import numpy as np
+
+# Prior used for every parameter without an informative prior
+DEFAULT_LOC = 0
+DEFAULT_SCALE = 10
+
+class PriorStore:
+
+    """
+    Informative priors for the intercepts and coefficients of an LVM.
+
+    Priors are kept in the per node format used by `LVM.informative_priors`,
+    e.g. `{"Erk": {"Erk_int": 0., "Erk_int_scale": 1., "Erk_Mek_coef": 1.,
+    "Erk_Mek_coef_scale": .5}}`. The per node prior dictionaries and the
+    prior arrays of the vectorized models are cached per graph, so reusing
+    a store across fits costs no parsing.
+
+    Parameters
+    ----------
+    priors : dict
+        Per node informative priors. Nodes and parameters that are left out
+        get the uninformative default prior.
+    """
+
+    def __init__(self, priors=None):
+
+        self.priors = dict() if priors is None else dict(priors)
+        self.node_cache = dict()
+        self.array_cache = dict()
+
+    def __repr__(self):
+        return f"PriorStore with informative priors for {len(self)} nodes"
+
+    def __len__(self):
+        return len(self.priors)
+
+    def __contains__(self, node):
+        return node in self.priors
+
+    @classmethod
+    def from_lvm(cls, lvm, scale_factor=1.):
+
+        """
+        Use the posterior of a fitted numpyro LVM as informative priors.
+
+        Parameters
+        ----------
+        lvm : MScausality.causal_model.LVM
+            A fitted LVM with `learned_params`.
+        scale_factor : float
+            Factor the posterior standard deviations are inflated by.
+
+        Returns
+        -------
+        PriorStore
+            Priors for every root and descendent node of the fitted graph.
+        """
+
+        if not hasattr(lvm, "learned_params"):
+            raise ValueError("The LVM has no learned_params, fit it with "
+                             "a numpyro backend first.")
+
+        params = lvm.learned_params
+        priors = dict()
+
+        for node in lvm.root_nodes:
+            priors[node] = {
+                f"{node}_int": params[f"{node}_int"],
+                f"{node}_int_scale": params[f"{node}_int_scale"] * scale_factor}
+
+        for node, parents in lvm.descendent_nodes.items():
+            node_priors = {
+                f"{node}_int": params[f"{node}_intercept"],
+                f"{node}_int_scale":
+                    params[f"{node}_intercept_scale"] * scale_factor}
+            for parent in parents:
+                name = f"{node}_{parent}_coef"
+                node_priors[name] = params[name]
+                node_priors[f"{name}_scale"] = \
+                    params[f"{name}_scale"] * scale_factor
+            priors[node] = node_priors
+
+        return cls(priors)
+
+    def validate(self, root_nodes, descendent_nodes):
+
+        """
+        Check that the informative priors of the graph parameters have a
+        finite location and a positive scale. Parameters without a stored
+        prior get the default prior and nodes outside of the graph are
+        ignored, so one store can serve related networks.
+
+        Parameters
+        ----------
+        root_nodes : list
+            A list of root nodes in the causal graph.
+        descendent_nodes : dict
+            Parents of each descendent node in the causal graph.
+        """
+
+        errors = list()
+        graph = {node: list() for node in root_nodes}
+        graph.update(descendent_nodes)
+
+        for node, parents in graph.items():
+            node_priors = self.priors.get(node, dict())
+            names = [f"{node}_int"] + [f"{node}_{parent}_coef"
+                                       for parent in parents]
+            for name in names:
+                if name in node_priors and \
+                        not np.isfinite(node_priors[name]):
+                    errors.append(f"{node}: invalid {name}")
+                if f"{name}_scale" in node_priors and \
+                        not node_priors[f"{name}_scale"] > 0:
+                    errors.append(f"{node}: invalid {name}_scale")
+
+        if len(errors) > 0:
+            raise ValueError("Invalid informative priors:\n" +
+                             "\n".join(errors))
+
+    def lookup(self, node, name):
+
+        """
+        Location and scale of the prior of parameter `name` of `node`, the
+        default prior if the store has none.
+        """
+
+        node_priors = self.priors.get(node, dict())
+        return (node_priors.get(name, DEFAULT_LOC),
+                node_priors.get(f"{name}_scale", DEFAULT_SCALE))
+
+    def node_priors(self, root_nodes, descendent_nodes):
+
+        """
+        Per node prior dictionaries, in the format `LVM.priors` is passed
+        to the models. Results are validated and cached per graph.
+
+        Parameters
+        ----------
+        root_nodes : list
+            A list of root nodes in the causal graph.
+        descendent_nodes : dict
+            Parents of each descendent node in the causal graph.
+
+        Returns
+        -------
+        dict
+            Priors of every node in the graph.
+        """
+
+        key = (tuple(root_nodes),
+               tuple((node, tuple(parents))
+                     for node, parents in descendent_nodes.items()))
+        if key in self.node_cache:
+            return self.node_cache[key]
+
+        self.validate(root_nodes, descendent_nodes)
+
+        priors = dict()
+        for node in root_nodes:
+            loc, scale = self.lookup(node, f"{node}_int")
+            priors[node] = {f"{node}_int": loc, f"{node}_int_scale": scale}
+
+        for node, parents in descendent_nodes.items():
+            node_priors = dict()
+            for parent in parents:
+                name = f"{node}_{parent}_coef"
+                loc, scale = self.lookup(node, name)
+                node_priors[name] = loc
+                node_priors[f"{name}_scale"] = scale
+            loc, scale = self.lookup(node, f"{node}_int")
+            node_priors[f"{node}_int"] = loc
+            node_priors[f"{node}_int_scale"] = scale
+            priors[node] = node_priors
+
+        self.node_cache[key] = priors
+        return priors
+
+    def arrays(self, structure):
+
+        """
+        Prior arrays aligned with the node and edge ordering of a graph
+        structure, as passed to the vectorized models. Results are cached
+        per structure.
+
+        Parameters
+        ----------
+        structure : dict
+            Graph structure returned by `build_model_structure`.
+
+        Returns
+        -------
+        dict
+            Arrays of intercept and coefficient prior locations and scales.
+        """
+
+        key = (tuple(structure["nodes"]), tuple(structure["edge_names"]))
+        if key in self.array_cache:
+            return self.array_cache[key]
+
+        intercepts = np.array([self.lookup(node, f"{node}_int")
+                               for node in structure["nodes"]], dtype=float)
+        coefs = np.array(
+            [self.lookup(structure["nodes"][child], name)
+             for child, name in zip(structure["edge_child"],
+                                    structure["edge_names"])],
+            dtype=float).reshape(-1, 2)
+
+        arrays = {"int_loc": intercepts[:, 0],
+                  "int_scale": intercepts[:, 1],
+                  "coef_loc": coefs[:, 0],
+                  "coef_scale": coefs[:, 1]}
+
+        self.array_cache[key] = arrays
+        return arrays
@@ -1,11 +1,14 @@
 
 import pandas as pd
 import numpy as np
+import networkx as nx
 import statsmodels.api as sm
 
 import torch
+from torch.utils.data import DataLoader, TensorDataset
+from numpyro.diagnostics import summary as numpyro_summary
 
-def calc_dpc(df: pd.DataFrame) -> float:
+def calc_dpc(df: pd.DataFrame, return_intercept: bool = False) -> float:
 
     """
     Calculate the detection probability curve (DPC) for a given dataset.
@@ -14,11 +17,14 @@ def calc_dpc(df: pd.DataFrame) -> float:
     ----------
     df : pd.DataFrame
         A pandas DataFrame containing the data in wide format (Proteins x Runs).
+    return_intercept : bool
+        Whether to also return the intercept of the DPC.
     
     Returns
     -------
     float
-        The slope of the DPC.
+        The slope of the DPC, or the (intercept, slope) tuple if 
+        `return_intercept` is True.
     """
 
     vals = pd.DataFrame(
@@ -29,9 +35,35 @@ def calc_dpc(df: pd.DataFrame) -> float:
     model = sm.GLM(vals["missing"], X, 
                 family=sm.families.Binomial(link=sm.families.links.logit()))
     result = model.fit()
-    
+
+    if return_intercept:
+        return result.params["const"], result.params["mean"]
     return result.params["mean"]
 
+def calc_probit_detection(df: pd.DataFrame) -> dict:
+
+    """
+    Probit detection model P(observed | y) = Phi((y - loc) / scale) matched 
+    to the logistic DPC of `calc_dpc`, using logistic(x) ~ Phi(x / 1.702).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        A pandas DataFrame containing the data in wide format (Runs x Proteins).
+    
+    Returns
+    -------
+    dict
+        The `loc` and `scale` of the detection model.
+    """
+
+    intercept, slope = calc_dpc(df, return_intercept=True)
+    if not slope > 0:
+        raise ValueError("Detection does not increase with intensity, the "
+                         "MNAR likelihood can not be used for this data.")
+
+    return {"loc": float(-intercept / slope), "scale": float(1.702 / slope)}
+
 def prep_data_for_model(root_nodes, 
                         descendent_nodes, 
                         input_data, 
@@ -72,4 +104,470 @@ def prep_data_for_model(root_nodes,
         condition_data[f"missing_{node}"] = torch.tensor(
             input_missing.loc[:, node].values)
 
-    return condition_data
\ No newline at end of file
+    return condition_data
+
+def compile_graph(causal_graph):
+
+    """
+    Compile a causal graph into the root nodes, parents of each descendent 
+    node and the integer-indexed structure used by the models, in time 
+    linear in the size of the graph. Every undirected edge is replaced by a 
+    latent confounder root node `latent_{i}`.
+
+    The result is cached on the graph, keyed by its node and edge sets, so 
+    a graph that is edited in place is compiled again.
+
+    Parameters
+    ----------
+    causal_graph : y0.graph.NxMixedGraph
+        The causal graph.
+    
+    Returns
+    -------
+    dict
+        Dictionary with the `root_nodes` list, the `descendent_nodes` dict 
+        and the `structure` returned by `build_model_structure`.
+    """
+
+    directed = causal_graph.directed
+    undirected = causal_graph.undirected
+    key = (frozenset(directed.nodes), frozenset(directed.edges), 
+           frozenset(undirected.edges))
+    cached = directed.graph.get("mscausality_compiled")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    # Roots have no parents, every other node keeps its parents in edge order
+    root_nodes = list()
+    descendent_nodes = dict()
+    for node in nx.topological_sort(directed):
+        if directed.in_degree(node) == 0:
+            root_nodes.append(node)
+        else:
+            descendent_nodes[node] = list(directed.predecessors(node))
+
+    # Latent confounders are roots, confounded roots become their children 
+    # and are placed in front of the other descendent nodes
+    roots = set(root_nodes)
+    confounded_roots = dict()
+    latent_nodes = list()
+    for i, edge in enumerate(undirected.edges()):
+        latent = f"latent_{i}"
+        latent_nodes.append(latent)
+        for node in edge:
+            if node in roots:
+                roots.remove(node)
+                confounded_roots[node] = [latent]
+            elif node in confounded_roots:
+                confounded_roots[node].append(latent)
+            else:
+                descendent_nodes[node].append(latent)
+
+    descendent_nodes = {
+        str(name): [str(item) for item in parents if item != name] 
+        for name, parents in list(reversed(confounded_roots.items())) + 
+        list(descendent_nodes.items())}
+    root_nodes = [str(node) for node in root_nodes if node in roots] + \
+        latent_nodes
+
+    compiled = {"root_nodes": root_nodes, 
+                "descendent_nodes": descendent_nodes, 
+                "structure": build_model_structure(root_nodes, 
+                                                   descendent_nodes, 
+                                                   latent_nodes)}
+    directed.graph["mscausality_compiled"] = (key, compiled)
+
+    return compiled
+
+def build_model_structure(root_nodes, descendent_nodes, latent_nodes=None):
+
+    """
+    Build an integer-indexed description of the causal graph for the 
+    vectorized models.
+
+    Parameters
+    ----------
+    root_nodes : list
+        A list of root nodes in the causal graph.
+    descendent_nodes : dict
+        A dictionary mapping each descendent node to its parents.
+    latent_nodes : list
+        The latent confounder nodes. By default nodes with "latent" in their 
+        name are latent.
+    
+    Returns
+    -------
+    dict
+        A dictionary containing the node order, the root indices, the edge 
+        list as parent/child index arrays and the topological layers.
+    """
+
+    nodes = list(root_nodes) + list(descendent_nodes.keys())
+    index = {name: i for i, name in enumerate(nodes)}
+    if latent_nodes is None:
+        latent_nodes = [i for i in nodes if "latent" in i]
+    latent_nodes = set(latent_nodes)
+
+    edge_parent = list()
+    edge_child = list()
+    edge_names = list()
+    for node_name, items in descendent_nodes.items():
+        for item in items:
+            edge_parent.append(index[item])
+            edge_child.append(index[node_name])
+            edge_names.append(f"{node_name}_{item}_coef")
+
+    # Depth of each node is one more than its deepest parent
+    depth = np.zeros(len(nodes), dtype=int)
+    for node_name, items in descendent_nodes.items():
+        if len(items) > 0:
+            depth[index[node_name]] = max(
+                depth[index[item]] for item in items) + 1
+    layers = [np.flatnonzero(depth == i) for i in range(depth.max() + 1)] \
+        if len(nodes) > 0 else list()
+
+    return {"nodes": nodes,
+            "index": index,
+            "roots": np.array([index[i] for i in root_nodes], dtype=int),
+            "latent": np.array([i in latent_nodes for i in nodes], 
+                               dtype=bool),
+            "edge_parent": np.array(edge_parent, dtype=int),
+            "edge_child": np.array(edge_child, dtype=int),
+            "edge_names": edge_names,
+            "layers": layers}
+
+def prep_matrix_data_for_model(structure, input_data, input_missing):
+
+    """
+    Prepare input data in matrix form for the vectorized models.
+
+    Parameters
+    ----------
+    structure : dict
+        Graph structure returned by `build_model_structure`.
+    input_data : pd.DataFrame
+        A pandas DataFrame containing the data in wide format (Runs x Proteins).
+    input_missing : pd.DataFrame
+        A pandas DataFrame containing missing info in wide format 
+        (Runs x Proteins).
+    
+    Returns
+    -------
+    tuple
+        The (Runs x Nodes) data matrix with missing values set to zero and the 
+        matching boolean missingness mask. Latent nodes are fully missing.
+    """
+
+    n_obs = len(input_data)
+    data = np.zeros((n_obs, len(structure["nodes"])))
+    missing = np.ones((n_obs, len(structure["nodes"])), dtype=bool)
+
+    for node, i in structure["index"].items():
+        if not structure["latent"][i]:
+            data[:, i] = np.nan_to_num(
+                np.asarray(input_data.loc[:, node].values, dtype=float))
+            missing[:, i] = np.asarray(
+                input_missing.loc[:, node].values, dtype=bool)
+
+    return data, missing
+
+def iterate_minibatches(data, missing, batch_size, seed=0):
+
+    """
+    Endless iterator over shuffled minibatches of the matrix model inputs, 
+    reshuffled after every pass through the runs. All minibatches have the 
+    same size, so that compiled ELBOs are traced once.
+
+    Parameters
+    ----------
+    data : torch.Tensor
+        (Runs x Nodes) data matrix from `prep_matrix_data_for_model`.
+    missing : torch.Tensor
+        (Runs x Nodes) missingness mask from `prep_matrix_data_for_model`.
+    batch_size : int
+        Number of runs per minibatch.
+    seed : int
+        Seed of the shuffling.
+    
+    Yields
+    ------
+    tuple
+        The run indices, data rows and missingness rows of a minibatch.
+    """
+
+    loader = DataLoader(
+        TensorDataset(torch.arange(len(data)), data, missing), 
+        batch_size=min(batch_size, len(data)), shuffle=True, drop_last=True,
+        generator=torch.Generator().manual_seed(seed))
+
+    while True:
+        for batch in loader:
+            yield batch
+
+def pad_run_sites(values, shapes, fill=0.):
+
+    """
+    Align per site values of a previous fit with the sites of a model fit 
+    on more runs. Sites with one entry per run (imputation and latent 
+    values) are extended along the run axis with `fill`.
+
+    Parameters
+    ----------
+    values : dict
+        Values of the previous fit keyed by site name.
+    shapes : dict
+        Site shapes of the new model keyed by site name.
+    fill : float
+        Value of the entries of the new runs.
+    
+    Returns
+    -------
+    dict
+        Values with the new model shapes, sites that are missing or cannot 
+        be aligned are left out.
+    """
+
+    padded = dict()
+
+    for name, shape in shapes.items():
+        if name not in values:
+            continue
+        value = np.asarray(values[name], dtype=float)
+        shape = tuple(shape)
+        if value.shape != shape:
+            if len(shape) == 0 or value.shape[1:] != shape[1:] or \
+                    value.shape[0] > shape[0]:
+                continue
+            value = np.concatenate(
+                [value, np.full((shape[0] - value.shape[0],) + shape[1:], 
+                                fill)])
+        padded[name] = value
+
+    return padded
+
+def build_spline_basis(structure, data, missing, spline_edges, n_knots=3, 
+                       prior_scale=1.):
+
+    """
+    Precompute the piecewise-linear basis of nonlinear edges.
+
+    The effect of a spline edge is its linear coefficient times the parent 
+    plus a weighted sum of hinges max(parent - knot, 0), so the slope can 
+    change at each knot. Knots are placed at evenly spaced quantiles of the 
+    observed parent values. The hinges of all spline edges are evaluated 
+    with one einsum, the child matrix scatters them onto the child nodes.
+
+    Parameters
+    ----------
+    structure : dict
+        Graph structure returned by `build_model_structure`.
+    data : np.ndarray
+        (Runs x Nodes) data matrix returned by `prep_matrix_data_for_model`.
+    missing : np.ndarray
+        (Runs x Nodes) boolean missingness mask.
+    spline_edges : list or str
+        (parent, child) pairs of the nonlinear edges, or "all".
+    n_knots : int
+        Number of knots per edge.
+    prior_scale : float
+        Scale of the normal prior on the hinge weights.
+    
+    Returns
+    -------
+    dict
+        Parent index (Splines,), knots and prior scales (Splines x Knots), 
+        the (Splines x Nodes) child matrix and the edge names.
+    """
+
+    edges = {(structure["nodes"][parent], structure["nodes"][child]): i 
+             for i, (parent, child) in enumerate(zip(structure["edge_parent"], 
+                                                     structure["edge_child"]))}
+    if isinstance(spline_edges, str) and spline_edges == "all":
+        spline_edges = list(edges)
+    spline_edges = [tuple(edge) for edge in spline_edges]
+
+    unknown = [edge for edge in spline_edges if edge not in edges]
+    if len(unknown) > 0:
+        raise ValueError(f"Spline edges not in the graph: {unknown}")
+
+    parent = np.array([structure["edge_parent"][edges[edge]] 
+                       for edge in spline_edges], dtype=int)
+    child = np.array([structure["edge_child"][edges[edge]] 
+                      for edge in spline_edges], dtype=int)
+
+    quantiles = np.linspace(0, 1, n_knots + 2)[1:-1]
+    knots = np.zeros((len(spline_edges), n_knots))
+    for i, (edge, j) in enumerate(zip(spline_edges, parent)):
+        observed = data[~missing[:, j], j]
+        if structure["latent"][j] or len(observed) == 0:
+            raise ValueError(f"Spline edge {edge} needs an observed parent")
+        knots[i] = np.quantile(observed, quantiles)
+
+    child_matrix = np.zeros((len(spline_edges), len(structure["nodes"])))
+    child_matrix[np.arange(len(spline_edges)), child] = 1.
+
+    return {"parent": parent,
+            "knots": knots,
+            "prior_scale": np.full(knots.shape, prior_scale, dtype=float),
+            "child_matrix": child_matrix,
+            "names": [f"{target}_{source}" for source, target in spline_edges]}
+
+def unpack_samples(samples, structure, splines=None):
+
+    """
+    Split the array valued sites of the vectorized models into the per node 
+    sites used by `NumpyroProteomicPerturbationModel`.
+
+    Parameters
+    ----------
+    samples : dict
+        Posterior samples, with any number of leading sample dimensions.
+    structure : dict
+        Graph structure returned by `build_model_structure`.
+    splines : dict
+        Spline basis returned by `build_spline_basis`, if the model has 
+        spline edges. Hinge weights are split into `{edge}_spline_{k}` 
+        sites.
+    
+    Returns
+    -------
+    dict
+        Posterior samples keyed by the per node site names.
+    """
+
+    nodes = structure["nodes"]
+    roots = set(structure["roots"].tolist())
+    unpacked = dict()
+
+    for i, node in enumerate(nodes):
+        int_name = f"{node}_int" if i in roots else f"{node}_intercept"
+        unpacked[int_name] = samples["intercept"][..., i]
+        unpacked[f"{node}_scale"] = samples["scale"][..., i]
+
+    for i, name in enumerate(structure["edge_names"]):
+        unpacked[name] = samples["coef"][..., i]
+
+    if splines is not None and "spline_coef" in samples:
+        for i, name in enumerate(splines["names"]):
+            for k in range(splines["knots"].shape[1]):
+                unpacked[f"{name}_spline_{k}"] = \
+                    samples["spline_coef"][..., i, k]
+
+    if "latent" in samples:
+        for j, i in enumerate(np.flatnonzero(structure["latent"])):
+            unpacked[nodes[i]] = samples["latent"][..., j]
+
+    if "imp" in samples:
+        for i, node in enumerate(nodes):
+            values = samples["imp"][..., i]
+            if structure["latent"][i]:
+                unpacked[node] = values
+            else:
+                unpacked[f"imp_{node}"] = values
+
+    return unpacked
+
+def iter_draw_chunks(value, chunk_size):
+
+    """
+    Copy the draws of a grouped (chains x draws x ...) site to host memory 
+    a chunk at a time.
+    """
+
+    for start in range(0, value.shape[1], chunk_size):
+        yield np.asarray(value[:, start:start + chunk_size], dtype=float)
+
+def streaming_moments(samples, chunk_size=256):
+
+    """
+    Posterior mean and standard deviation of each site, accumulated over 
+    chunks of draws with Welford's algorithm so that only one chunk of a 
+    site is held in host memory at a time.
+
+    Parameters
+    ----------
+    samples : dict
+        Posterior samples grouped by chain (chains x draws x ...).
+    chunk_size : int
+        Number of draws per chain copied to host memory at once.
+    
+    Returns
+    -------
+    dict
+        Dictionary with the elementwise `mean`, `std` and the number of 
+        draws `n` of each site. Standard deviations use ddof=0.
+    """
+
+    moments = dict()
+
+    for name, value in samples.items():
+        mean = np.zeros(value.shape[2:])
+        m2 = np.zeros(value.shape[2:])
+        n = 0
+        for chunk in iter_draw_chunks(value, chunk_size):
+            chunk = chunk.reshape((-1,) + value.shape[2:])
+            chunk_n = chunk.shape[0]
+            chunk_mean = chunk.mean(axis=0)
+            delta = chunk_mean - mean
+            total = n + chunk_n
+            mean = mean + delta * chunk_n / total
+            m2 = m2 + ((chunk - chunk_mean)**2).sum(axis=0) + \
+                delta**2 * n * chunk_n / total
+            n = total
+        moments[name] = {"mean": mean, 
+                         "std": np.sqrt(m2 / max(n, 1)), 
+                         "n": n}
+
+    return moments
+
+def summarize_samples(samples, prob=.9, site_filter=None, chunk_size=256):
+
+    """
+    Diagnostics of `numpyro.diagnostics.summary` computed a chunk of 
+    elements at a time. Only the draws of one chunk of a site's elements 
+    are copied to host memory at once, instead of the whole posterior.
+
+    Parameters
+    ----------
+    samples : dict
+        Posterior samples grouped by chain (chains x draws x ...).
+    prob : float
+        The probability mass of samples within the HPDI interval.
+    site_filter : callable
+        Called with each site name, sites for which it returns False are 
+        skipped. By default every site is summarized.
+    chunk_size : int
+        Number of site elements summarized at once.
+    
+    Returns
+    -------
+    dict
+        Summary statistics keyed by site name, in the format of 
+        `numpyro.diagnostics.summary`.
+    """
+
+    summary_stats = dict()
+
+    for name, value in samples.items():
+        if site_filter is not None and not site_filter(name):
+            continue
+        event_shape = value.shape[2:]
+        size = int(np.prod(event_shape))
+        if size == 0:
+            continue
+        flat = value.reshape(value.shape[:2] + (size,))
+
+        site_stats = dict()
+        for start in range(0, size, chunk_size):
+            chunk = np.asarray(flat[..., start:start + chunk_size])
+            chunk_stats = numpyro_summary({name: chunk}, prob, 
+                                          group_by_chain=True)[name]
+            for stat, result in chunk_stats.items():
+                if stat not in site_stats:
+                    site_stats[stat] = np.empty(size)
+                site_stats[stat][start:start + chunk.shape[2]] = result
+
+        summary_stats[name] = {stat: result.reshape(event_shape) 
+                               for stat, result in site_stats.items()}
+
+    return summary_stats
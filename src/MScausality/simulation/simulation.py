@@ -4,6 +4,7 @@ import pandas as pd
 import networkx as nx
 
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -48,24 +49,23 @@ def simulate_data(graph,
         A dictionary of interventions to apply to the data. Default is None.
     n : int
         The number of samples to simulate.
-    seed : int
-        The seed to use for the random number generator.
+    seed : int, numpy.random.SeedSequence or numpy.random.Generator
+        The root of the random streams, see `simulation_streams`. The global 
+        numpy random state is never used.
 
     Returns
     -------
     data : pandas.DataFrame
         The simulated data.
     """
-    if seed is not None:
-        np.random.seed(seed)
+    sorted_nodes = [i for i in nx.topological_sort(graph) if i != "cell_type"]
+    streams = simulation_streams(seed, sorted_nodes)
 
     if coefficients is None:
-        coefficients = generate_coefficients(graph)
+        coefficients = generate_coefficients(graph, streams["coefficients"])
 
     data = dict()#pd.DataFrame(columns=graph.nodes())
 
-    sorted_nodes = [i for i in nx.topological_sort(graph) if i != "cell_type"]
-
     print("simulating data...")
     for node in sorted_nodes:
         node_coefficients = coefficients[node]
@@ -75,7 +75,7 @@ def simulate_data(graph,
             temp_int = None
 
         data[node] = simulate_node(data, node_coefficients, n, cell_type,
-                                   temp_int)
+                                   temp_int, streams["nodes"][node])
         
     if cell_type:
         data["cell_type"] = np.repeat([i for i in range(n_cells)], n//n_cells)
@@ -85,26 +85,17 @@ def simulate_data(graph,
     if add_error:
         if error_node is None:
             for node, _ in data.items():
-                data[node] += np.random.normal(0, 1, n)
+                data[node] += streams["error"].normal(0, 1, n)
         else:
-            data[error_node] += np.random.normal(0, 5, n)
+            data[error_node] += streams["error"].normal(0, 5, n)
 
     # break data into features
     if add_feature_var:
         print("adding feature level data...")
-        feature_level_data_list = list()
-        for node in sorted_nodes:
-            feature_level_data_list.append(generate_features(data[node], node))
-
-        feature_level_data = pd.concat(feature_level_data_list, 
-                                       ignore_index=True)
-
-        print("masking data...")
-        if include_missing:
-            feature_level_data = add_missing(
-                feature_level_data, 
-                mar_missing_param, 
-                mnar_missing_param)
+        feature_level_data = simulate_features(data, sorted_nodes, streams, 
+                                               include_missing, 
+                                               mar_missing_param, 
+                                               mnar_missing_param)
     else:
         feature_level_data = None
 
@@ -112,57 +103,296 @@ def simulate_data(graph,
             "Feature_data" : feature_level_data, 
             "Coefficients" : coefficients}
 
-def generate_coefficients(graph):
+def simulate_many(graph,
+                  coefficients,
+                  seeds,
+                  n,
+                  intervention=dict(),
+                  add_feature_var=False,
+                  include_missing=True,
+                  mar_missing_param=.05,
+                  mnar_missing_param=[-3, .4],
+                  n_jobs=None):
+    """Simulate one dataset per seed from a graph in a single pass.
+
+    Each node is simulated for all datasets at once, in topological order. 
+    Dataset d draws from the streams of `seeds[d]`, so its protein data is 
+    identical to `simulate_data(graph, coefficients, seed=seeds[d], n=n, 
+    add_feature_var=False)`.
+
+    Parameters
+    ----------
+    graph : networkx.DiGraph
+        The graph to simulate data from.
+    coefficients : dict
+        A dictionary of coefficients to use for the simulation. If None, 
+        random coefficients are generated for each dataset.
+    seeds : list
+        The seed of each dataset, see `simulation_streams`.
+    n : int
+        The number of samples to simulate per dataset.
+    intervention : dict
+        A dictionary of interventions to apply to the data.
+    add_feature_var : bool
+        Whether to also simulate feature level data.
+    include_missing : bool
+        Whether to include missing data in the feature level data.
+    mar_missing_param : float
+        The probability of missing data for missing at random (MAR) missingness.
+    mnar_missing_param : list
+        The parameters for missing not at random (MNAR) missingness.
+    n_jobs : int
+        The number of processes to simulate the feature level data with. If 
+        None, it is simulated in this process.
+
+    Returns
+    -------
+    data : dict
+        The (Datasets x Samples x Nodes) protein data, the node order of its 
+        last axis, a feature level DataFrame per dataset (None without 
+        feature level data) and the coefficients, one dictionary per dataset 
+        if they were generated.
+    """
+    sorted_nodes = [i for i in nx.topological_sort(graph) if i != "cell_type"]
+    index = {node: i for i, node in enumerate(sorted_nodes)}
+    streams = [simulation_streams(seed, sorted_nodes) for seed in seeds]
+
+    if coefficients is None:
+        dataset_coefficients = [
+            generate_coefficients(graph, dataset_streams["coefficients"]) 
+            for dataset_streams in streams]
+    else:
+        dataset_coefficients = [coefficients for _ in seeds]
+
+    remove = ["intercept", "error", "cell_type"]
+    data = np.zeros((len(seeds), n, len(sorted_nodes)))
+
+    for node in sorted_nodes:
+        node_coefficients = [i[node] for i in dataset_coefficients]
+        parents = [i for i in node_coefficients[0] if i not in remove]
+
+        # Same order of operations as simulate_node
+        node_data = np.array([i["intercept"] for i in node_coefficients], 
+                             dtype=float)[:, None]
+        for parent in parents:
+            coef = np.array([i[parent] for i in node_coefficients], 
+                            dtype=float)[:, None]
+            node_data = node_data + coef * data[:, :, index[parent]]
+
+        node_data = node_data + np.stack(
+            [dataset_streams["nodes"][node].normal(0, i["error"], n) 
+             for dataset_streams, i in zip(streams, node_coefficients)])
+
+        if node in intervention.keys():
+            node_data = np.full((len(seeds), n), intervention[node], 
+                                dtype=float)
+
+        data[:, :, index[node]] = node_data
+
+    feature_level_data = None
+    if add_feature_var:
+        args = [({node: data[d, :, i] for node, i in index.items()}, 
+                 sorted_nodes, streams[d], include_missing, 
+                 mar_missing_param, mnar_missing_param) 
+                for d in range(len(seeds))]
+        if n_jobs is None:
+            feature_level_data = [simulate_features(*i) for i in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                feature_level_data = list(executor.map(simulate_features, 
+                                                       *zip(*args)))
+
+    return {"Protein_data" : data,
+            "Nodes" : sorted_nodes,
+            "Feature_data" : feature_level_data,
+            "Coefficients" : coefficients if coefficients is not None 
+                             else dataset_coefficients}
+
+def simulate_features(data, 
+                      nodes, 
+                      streams, 
+                      include_missing=True,
+                      mar_missing_param=.05,
+                      mnar_missing_param=[-3, .4]):
+    """Simulate the feature level data of one dataset.
+
+    Parameters
+    ----------
+    data : dict
+        The protein level data of each node.
+    nodes : list
+        The nodes to generate features for, in order.
+    streams : dict
+        The random streams returned by `simulation_streams`.
+    include_missing : bool
+        Whether to include missing data.
+    mar_missing_param : float
+        The probability of missing data for missing at random (MAR) missingness.
+    mnar_missing_param : list
+        The parameters for missing not at random (MNAR) missingness.
+
+    Returns
+    -------
+    feature_level_data : pandas.DataFrame
+        The feature level data of every node.
+    """
+    feature_level_data = pd.concat(
+        [generate_features(data[node], node, streams["features"][node]) 
+         for node in nodes], ignore_index=True)
+
+    if include_missing:
+        feature_level_data = add_missing(feature_level_data, 
+                                         mar_missing_param, 
+                                         mnar_missing_param,
+                                         streams["missing"])
+
+    return feature_level_data
+
+def expected_values(graph, coefficients, intervention=dict()):
+    """Expected value of each node of a linear simulation.
+
+    Means are propagated over `nx.topological_sort`: each node is its 
+    intercept plus the coefficient weighted means of its parents, and 
+    intervened nodes are fixed. The noise terms of `simulate_node` have 
+    zero mean, so the result is exact for `simulate_data` without cell 
+    types or added error.
+
+    Parameters
+    ----------
+    graph : networkx.DiGraph
+        The graph to propagate the means over.
+    coefficients : dict
+        A dictionary of coefficients for each node.
+    intervention : dict
+        A dictionary of interventions, mapping nodes to fixed values.
+
+    Returns
+    -------
+    means : dict
+        The expected value of each node.
+    """
+    remove = ["intercept", "error", "cell_type"]
+    means = dict()
+
+    for node in nx.topological_sort(graph):
+        if node == "cell_type":
+            continue
+        if node in intervention.keys():
+            means[node] = float(intervention[node])
+            continue
+
+        mean = coefficients[node]["intercept"]
+        for parent, coef in coefficients[node].items():
+            if parent not in remove:
+                mean += coef * means[parent]
+        means[node] = float(mean)
+
+    return means
+
+def simulation_streams(seed, nodes):
+    """Spawn independent random streams for each stage of a simulation.
+
+    The root seed sequence is split into coefficient, node, error, feature 
+    and missingness stages, and the node and feature stages into one child 
+    per node. Each stream only depends on the seed and its position, so 
+    simulations are reproducible regardless of call order and can run in 
+    parallel threads or processes.
+
+    Parameters
+    ----------
+    seed : int, numpy.random.SeedSequence or numpy.random.Generator
+        The root of the streams. A Generator spawns a child of its seed 
+        sequence, None draws fresh entropy.
+    nodes : list
+        The nodes in the order they are simulated.
+
+    Returns
+    -------
+    streams : dict
+        Generators for the coefficients, error and missing stages, and 
+        dictionaries of per node Generators for the nodes and features 
+        stages.
+    """
+    if isinstance(seed, np.random.Generator):
+        seed_seq = seed.bit_generator.seed_seq.spawn(1)[0]
+    elif isinstance(seed, np.random.SeedSequence):
+        seed_seq = seed
+    else:
+        seed_seq = np.random.SeedSequence(seed)
+
+    coefficients, node_seq, error, features, missing = seed_seq.spawn(5)
+
+    return {"coefficients": np.random.default_rng(coefficients),
+            "nodes": {node: np.random.default_rng(child) for node, child 
+                      in zip(nodes, node_seq.spawn(len(nodes)))},
+            "error": np.random.default_rng(error),
+            "features": {node: np.random.default_rng(child) for node, child 
+                         in zip(nodes, features.spawn(len(nodes)))},
+            "missing": np.random.default_rng(missing)}
+
+def generate_coefficients(graph, rng=None):
     """Generate random coefficients for a graph.
 
     Parameters
     ----------
     graph : networkx.DiGraph
         The graph to generate coefficients for.
+    rng : numpy.random.Generator
+        The random number generator to use. If None, a fresh Generator is 
+        created.
 
     Returns
     -------
     coefficients : dict
         A dictionary of coefficients for each node.
     """
+    if rng is None:
+        rng = np.random.default_rng()
+
     coefficients = {}
 
     for node in graph.nodes():
         parents = list(graph.predecessors(node))
-        coefficients[node] = generate_node_coefficients(parents)
+        coefficients[node] = generate_node_coefficients(parents, rng)
 
     return coefficients
 
-def generate_node_coefficients(parents):
+def generate_node_coefficients(parents, rng=None):
     """Generate random coefficients for a node.
 
     Parameters
     ----------
     parents : list
         The parents of the node.
+    rng : numpy.random.Generator
+        The random number generator to use. If None, a fresh Generator is 
+        created.
 
     Returns
     -------
     coefficients : dict
         A dictionary of coefficients for the node.
     """
+    if rng is None:
+        rng = np.random.default_rng()
+
     coefficients = {}
 
     for parent in parents:
-        coefficients[parent] = np.random.choice([np.random.uniform(-1., -.5),
-                                                 np.random.uniform(.5, 1.5)])
+        coefficients[parent] = rng.choice([rng.uniform(-1., -.5),
+                                           rng.uniform(.5, 1.5)])
 
 
     if len(coefficients.keys()) == 0:
-        coefficients["intercept"] = np.random.uniform(15, 25)
+        coefficients["intercept"] = rng.uniform(15, 25)
     else:
-        coefficients["intercept"] = np.random.uniform(-5, 5)
+        coefficients["intercept"] = rng.uniform(-5, 5)
 
-    coefficients["error"] = np.random.uniform(0,1)
+    coefficients["error"] = rng.uniform(0,1)
 
     return coefficients
 
-def simulate_node(data, coefficients, n, cell_type, intervention):
+def simulate_node(data, coefficients, n, cell_type, intervention, rng=None):
     """Simulate a node.
 
     Parameters
@@ -177,11 +407,17 @@ def simulate_node(data, coefficients, n, cell_type, intervention):
         Whether cell type is included in the simulation.
     intervention : dict
         A dictionary of interventions to apply to the data.
+    rng : numpy.random.Generator
+        The random number generator to use. If None, a fresh Generator is 
+        created.
     Returns
     -------
     node_data : numpy.ndarray
         The simulated node data.
     """
+    if rng is None:
+        rng = np.random.default_rng()
+
 
     remove = ["intercept", "error", "cell_type"]
     parents = list(coefficients.keys())
@@ -200,14 +436,14 @@ def simulate_node(data, coefficients, n, cell_type, intervention):
         for i in range(len(cells)):
             node_data[(i*n_obs_per_cell):(i*n_obs_per_cell+n_obs_per_cell)] += cells[i]
 
-    node_data += np.random.normal(0, coefficients["error"], n)
+    node_data += rng.normal(0, coefficients["error"], n)
 
     if intervention is not None:
         node_data = np.repeat(intervention, n)
 
     return node_data
 
-def generate_features(data, node):
+def generate_features(data, node, rng=None):
     """Generate features from a list of data.
 
     Parameters
@@ -218,34 +454,37 @@ def generate_features(data, node):
     node : str
         The node to generate features for.
 
+    rng : numpy.random.Generator
+        The random number generator to use. If None, a fresh Generator is 
+        created.
+
     Returns
     -------
-    feature_level_data : list
-        The data at the feature level.
+    feature_level_data : pandas.DataFrame
+        The data at the feature level, one row per replicate and feature.
     """
-    feature_level_data = pd.DataFrame(columns=["Protein", "Replicate", 
-                                               "Feature", "Intensity"])
-
-    number_features = np.random.randint(15, 30)
-    feature_effects = [np.random.uniform(-.75, .75) for _ in range(number_features)]
-
-    for i in range(len(data)):
-        for j in range(number_features):
-            
-            # Measurement error
-            error = np.random.normal(0, .1)
-            feature_level_data = pd.concat(
-                [feature_level_data, 
-                 pd.DataFrame(
-                     {"Protein": [node],
-                      "Replicate": [i],
-                      "Feature": [j],
-                      "Intensity": [data[i] + feature_effects[j] + error]}
-                      )], ignore_index=True)
+    if rng is None:
+        rng = np.random.default_rng()
+
+    data = np.asarray(data, dtype=float)
+
+    number_features = rng.integers(15, 30)
+    feature_effects = rng.uniform(-.75, .75, number_features)
+
+    # Measurement error, drawn in replicate major order
+    error = rng.normal(0, .1, (len(data), number_features))
+    intensity = data[:, None] + feature_effects[None, :] + error
+
+    feature_level_data = pd.DataFrame(
+        {"Protein": np.full(intensity.size, node, dtype=object),
+         "Replicate": np.repeat(np.arange(len(data)), number_features),
+         "Feature": np.tile(np.arange(number_features), len(data)),
+         "Intensity": intensity.ravel()})
 
     return feature_level_data
 
-def add_missing(feature_level_data, mar_missing_param, mnar_missing_param):
+def add_missing(feature_level_data, mar_missing_param, mnar_missing_param,
+                rng=None):
     """Add missing data to a feature level dataset.
 
     Parameters
@@ -256,33 +495,31 @@ def add_missing(feature_level_data, mar_missing_param, mnar_missing_param):
         The probability of missing data for missing at random (MAR) missingness.
     mnar_missing_param : list
         The parameters for missing not at random (MNAR) missingness.
+    rng : numpy.random.Generator
+        The random number generator to draw the masks from. If None, a 
+        fresh Generator is created.
     Returns
     -------
     feature_level_data : pandas.DataFrame
         The feature level data with missing data added.
     """
-
-    feature_level_data.loc[:, "Obs_Intensity"] = feature_level_data.loc[:, "Intensity"]
-
-    for i in range(len(feature_level_data)):
-        mar_prob = np.random.uniform(0, 1)
-        mnar_prob = np.random.uniform(0, 1)
-
-        mnar_thresh = 1 / (1 + np.exp(mnar_missing_param[0] +
-                                      (mnar_missing_param[1] * feature_level_data.loc[i, "Intensity"])))
-        feature_level_data.loc[i, "MNAR_threshold"] = mnar_thresh
-
-        if mar_prob < mar_missing_param:
-            feature_level_data.loc[i, "Obs_Intensity"] = np.nan
-            feature_level_data.loc[i, "MAR"] = True
-        else:
-            feature_level_data.loc[i, "MAR"] = False
-
-        if mnar_prob < mnar_thresh:
-            feature_level_data.loc[i, "Obs_Intensity"] = np.nan
-            feature_level_data.loc[i, "MNAR"] = True
-        else:
-            feature_level_data.loc[i, "MNAR"] = False
+    if rng is None:
+        rng = np.random.default_rng()
+
+    intensity = feature_level_data["Intensity"].to_numpy(dtype=float)
+
+    # One MAR and one MNAR uniform per row, in row major order
+    probs = rng.uniform(0, 1, (len(intensity), 2))
+    mnar_thresh = 1 / (1 + np.exp(mnar_missing_param[0] +
+                                  (mnar_missing_param[1] * intensity)))
+    mar = probs[:, 0] < mar_missing_param
+    mnar = probs[:, 1] < mnar_thresh
+
+    feature_level_data["Obs_Intensity"] = np.where(mar | mnar, np.nan, 
+                                                   intensity)
+    feature_level_data["MNAR_threshold"] = mnar_thresh
+    feature_level_data["MAR"] = mar
+    feature_level_data["MNAR"] = mnar
 
     return feature_level_data
 
@@ -1,8 +1,8 @@
 
 import pandas as pd
 
-from MScausality.causal_model.LVM import LVM
-from MScausality.simulation.simulation import simulate_data
+from MScausality.causal_model.LVM import LVM, configure_devices
+from MScausality.simulation.simulation import simulate_data, expected_values
 from MScausality.data_analysis.normalization import normalize
 
 import pyro
@@ -19,19 +19,29 @@ def validate_model(data,
                    int1, 
                    int2, 
                    outcome,
-                   priors=None):
+                   priors=None,
+                   gt_method="analytic"):
     """
     Validate a model using the provided data.
     
     Parameters
     ----------
+    gt_method : str
+        How the ground truth effect is computed, "analytic" for the exact 
+        effect of `analytic_ate` or "simulation" for the Monte Carlo 
+        estimate of `gt_ate`.
     
     Returns
     -------
 
     """
 
-    gt_effect = gt_ate(bulk_graph, coef, int1, int2, outcome)
+    if gt_method == "analytic":
+        gt_effect = analytic_ate(bulk_graph, coef, int1, int2, outcome)
+    elif gt_method == "simulation":
+        gt_effect = gt_ate(bulk_graph, coef, int1, int2, outcome)
+    else:
+        raise ValueError(f"Unknown gt_method {gt_method}")
     eliator_effect = eliator_ate(y0_graph_bulk, data, int1, int2, outcome)
     mscausality_effect = mscausality_ate(msscausality_graph, 
                                          data, int1, int2, 
@@ -78,6 +88,30 @@ def gt_ate(bulk_graph, coef, int1, int2, outcome):
     
     return gt_ate
 
+def analytic_ate(bulk_graph, coef, int1, int2, outcome):
+
+    """
+    Calculate the exact effect of two interventions on a linear simulated 
+    graph, by propagating the expected values of the nodes under each 
+    intervention with `expected_values`.
+
+    Parameters
+    ----------
+    bulk_graph : networkx.DiGraph
+        The graph to use for the comparison.
+    coef : dict
+        The coefficients of the graph.
+    int1 : dict
+        The first intervention to compare, any number of nodes.
+    int2 : dict
+        The second intervention to compare, any number of nodes.
+    outcome : str
+        The outcome to measure the effect.
+    """
+
+    return expected_values(bulk_graph, coef, int2)[outcome] \
+        - expected_values(bulk_graph, coef, int1)[outcome]
+
 def eliator_ate(y0_graph_bulk, data, int1, int2, outcome):
 
     """
@@ -160,6 +194,8 @@ def mscausality_ate(msscausality_graph, data, int1, int2, outcome, priors):
 
 def main():
 
+    configure_devices()
+
     from MScausality.simulation.simulation import simulate_data
     from MScausality.data_analysis.dataProcess import dataProcess
     from MScausality.simulation.example_graphs import signaling_network
@@ -0,0 +1,151 @@
+import tempfile
+import unittest
+
+import jax
+import numpy as np
+import pandas as pd
+
+from y0.dsl import Variable
+from y0.graph import NxMixedGraph
+
+from MScausality.causal_model.LVM import LVM, clear_mcmc_cache
+from MScausality.simulation.simulation import simulate_data
+from MScausality.simulation.example_graphs import signaling_network
+
+
+def simulated_data(n=40, seed=2, missing=.15):
+    sn = signaling_network(add_independent_nodes=False)
+    data = simulate_data(sn["Networkx"], coefficients=sn["Coefficients"],
+                         add_feature_var=False, n=n, seed=seed)
+    data = pd.DataFrame(data["Protein_data"])
+    data = (data - data.stack().mean()) / data.stack().std()
+    rng = np.random.default_rng(seed)
+    return data.mask(rng.uniform(size=data.shape) < missing), sn
+
+
+class CachedMCMCTestCase(unittest.TestCase):
+    def tearDown(self):
+        clear_mcmc_cache()
+
+    def test_vectorized_chains_refit_from_cache(self):
+        for seed in [2, 3]:
+            data, sn = simulated_data(seed=seed)
+            lvm = LVM(backend="numpyro", num_samples=50, warmup_steps=50,
+                      num_chains=2, vectorized=True, cache_mcmc=True,
+                      chain_method="vectorized")
+            lvm.fit(data, sn["MScausality"], verbose=False)
+
+            self.assertEqual(lvm.samples["coef"].shape, (2, 50, 7))
+            self.assertTrue(np.isfinite(lvm.linear_ate({"Ras": 1.},
+                                                       "Erk")).all())
+
+        # The cache hit must not expose the MCMC object of the first fit
+        self.assertIsNone(lvm.model)
+
+    def test_parallel_chains_without_devices_refit_from_cache(self):
+        for seed in [2, 3]:
+            data, sn = simulated_data(seed=seed)
+            lvm = LVM(backend="numpyro", num_samples=50, warmup_steps=50,
+                      num_chains=jax.local_device_count() + 1,
+                      vectorized=True, cache_mcmc=True,
+                      chain_method="parallel")
+            lvm.fit(data, sn["MScausality"], verbose=False)
+
+            self.assertEqual(lvm.get_chain_method(), "sequential")
+            self.assertEqual(lvm.samples["coef"].shape,
+                             (lvm.num_chains, 50, 7))
+
+
+class SaveLoadTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        data, sn = simulated_data()
+        lvm = LVM(backend="numpyro", num_samples=100, warmup_steps=100,
+                  num_chains=1, vectorized=True)
+        lvm.fit(data, sn["MScausality"], verbose=False)
+        lvm.intervention({"Ras": 1.}, "Erk")
+
+        for drop_imputation in [False, True]:
+            with tempfile.TemporaryDirectory() as path:
+                lvm.save(path, drop_imputation=drop_imputation)
+                loaded = LVM.load(path)
+                loaded.intervention({"Ras": 1.}, "Erk")
+
+                self.assertEqual("imp" in loaded.samples, not drop_imputation)
+                np.testing.assert_array_equal(loaded.samples["coef"],
+                                              lvm.samples["coef"])
+                np.testing.assert_array_equal(loaded.intervention_samples,
+                                              lvm.intervention_samples)
+                np.testing.assert_array_equal(loaded.posterior_samples,
+                                              lvm.posterior_samples)
+
+
+class UpdateTestCase(unittest.TestCase):
+    def test_update_with_new_runs(self):
+        data, sn = simulated_data(n=50)
+        settings = dict(backend="numpyro", num_samples=200, warmup_steps=200,
+                        num_chains=1, vectorized=True)
+        lvm = LVM(**settings)
+        lvm.fit(data.iloc[:40], sn["MScausality"], verbose=False)
+        lvm.update(data.iloc[40:], verbose=False)
+
+        self.assertEqual(len(lvm), 50)
+        self.assertEqual(lvm.samples["imp"].shape, (1, 200, 50, 7))
+
+        # The warm-started refit agrees with a fit to all runs
+        full = LVM(**settings)
+        full.fit(data, sn["MScausality"], verbose=False)
+        self.assertLess(abs(np.mean(lvm.linear_ate({"Ras": 1.}, "Erk")) -
+                            np.mean(full.linear_ate({"Ras": 1.}, "Erk"))),
+                        .15)
+
+
+class FitManyTestCase(unittest.TestCase):
+    def test_matches_separate_fits(self):
+        datasets = [simulated_data(seed=seed)[0] for seed in [2, 3]]
+        graph = signaling_network(add_independent_nodes=False)["MScausality"]
+        settings = dict(backend="numpyro", num_samples=300, warmup_steps=300,
+                        num_chains=1, vectorized=True)
+        fits = LVM(**settings).fit_many(datasets, graph, verbose=False)
+
+        self.assertEqual(len(fits), 2)
+        for data, fit in zip(datasets, fits):
+            separate = LVM(**settings)
+            separate.fit(data, graph, verbose=False)
+
+            self.assertEqual(fit.samples["coef"].shape, (1, 300, 7))
+            self.assertEqual(fit.imputed_data.shape,
+                             separate.imputed_data.shape)
+            self.assertLess(
+                abs(np.mean(fit.linear_ate({"Ras": 1.}, "Erk")) -
+                    np.mean(separate.linear_ate({"Ras": 1.}, "Erk"))), .15)
+
+
+class MNARTestCase(unittest.TestCase):
+    def test_latent_confounder(self):
+        # W -> X -> Z with X and Z confounded, the effect of X on Z is .4
+        rng = np.random.default_rng(0)
+        n = 500
+        u = rng.normal(size=n)
+        w = rng.normal(size=n)
+        x = .8 * w + u + .5 * rng.normal(size=n)
+        z = .4 * x + u + .5 * rng.normal(size=n)
+        data = pd.DataFrame({"W": w + 1., "X": x, "Z": z - .5})
+        data = data.mask(rng.uniform(size=data.shape) <
+                         1 / (1 + np.exp(3 * (data + .5))))
+
+        graph = NxMixedGraph.from_edges(
+            directed=[(Variable("W"), Variable("X")),
+                      (Variable("X"), Variable("Z"))],
+            undirected=[(Variable("X"), Variable("Z"))])
+        lvm = LVM(backend="numpyro", num_samples=300, warmup_steps=300,
+                  num_chains=1, vectorized=True, missing_model="mnar")
+        lvm.fit(data, graph, verbose=False)
+
+        ate = np.mean(lvm.linear_ate({"X": 1.}, "Z"))
+        self.assertLess(abs(ate - .4), .2)
+        self.assertNotIn("imp", lvm.samples)
+        self.assertEqual(lvm.samples["latent"].shape, (1, 300, n, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+
+from y0.dsl import Variable
+
+from MScausality.causal_model.priors import PriorStore, DEFAULT_LOC, \
+    DEFAULT_SCALE
+from MScausality.causal_model.utils import compile_graph
+from MScausality.simulation.example_graphs import signaling_network
+
+
+def signaling_priors():
+    return {"Ras": {"Ras_int": .5, "Ras_int_scale": .1},
+            "Erk": {"Erk_int": -.5, "Erk_int_scale": .2,
+                    "Erk_Mek_coef": .8, "Erk_Mek_coef_scale": .3}}
+
+
+class PriorStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.graph = signaling_network(
+            add_independent_nodes=False)["MScausality"]
+        self.store = PriorStore(signaling_priors())
+
+    def test_node_priors(self):
+        compiled = compile_graph(self.graph)
+        priors = self.store.node_priors(compiled["root_nodes"],
+                                        compiled["descendent_nodes"])
+
+        self.assertEqual(priors["Ras"], {"Ras_int": .5, "Ras_int_scale": .1})
+        self.assertEqual(priors["Erk"], signaling_priors()["Erk"])
+        self.assertEqual(priors["Mek"]["Mek_Raf_coef"], DEFAULT_LOC)
+        self.assertEqual(priors["Mek"]["Mek_Raf_coef_scale"], DEFAULT_SCALE)
+
+        arrays = self.store.arrays(compiled["structure"])
+        edge = compiled["structure"]["edge_names"].index("Erk_Mek_coef")
+        self.assertEqual(arrays["coef_loc"][edge], .8)
+        self.assertEqual(arrays["coef_scale"][edge], .3)
+
+    def test_graph_with_extra_edge(self):
+        self.graph.directed.add_edge(Variable("Raf"), Variable("Erk"))
+        compiled = compile_graph(self.graph)
+        priors = self.store.node_priors(compiled["root_nodes"],
+                                        compiled["descendent_nodes"])
+
+        # The new parent gets the default prior, stored priors are kept
+        self.assertEqual(priors["Erk"]["Erk_Raf_coef"], DEFAULT_LOC)
+        self.assertEqual(priors["Erk"]["Erk_Raf_coef_scale"], DEFAULT_SCALE)
+        self.assertEqual(priors["Erk"]["Erk_Mek_coef"], .8)
+        self.assertEqual(priors["Erk"]["Erk_int_scale"], .2)
+
+    def test_validate(self):
+        priors = signaling_priors()
+        priors["Erk"]["Erk_Mek_coef"] = np.nan
+        priors["Ras"]["Ras_int_scale"] = 0.
+        # Priors of nodes outside of the graph are not checked
+        priors["p38"] = {"p38_int": np.nan, "p38_int_scale": -1.}
+        compiled = compile_graph(self.graph)
+
+        with self.assertRaisesRegex(ValueError, "Erk_Mek_coef") as context:
+            PriorStore(priors).validate(compiled["root_nodes"],
+                                        compiled["descendent_nodes"])
+        self.assertIn("Ras_int_scale", str(context.exception))
+        self.assertNotIn("p38", str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
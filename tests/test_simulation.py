@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from MScausality.simulation.simulation import simulate_data, simulate_many, \
+    expected_values
+from MScausality.simulation.example_graphs import signaling_network
+
+
+class SimulateManyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sn = signaling_network(add_independent_nodes=False)
+        self.seeds = [1, 2, 3]
+
+    def assert_matches_simulate_data(self, coefficients, intervention):
+        many = simulate_many(self.sn["Networkx"], coefficients, self.seeds,
+                             n=100, intervention=intervention)
+
+        for d, seed in enumerate(self.seeds):
+            data = simulate_data(self.sn["Networkx"],
+                                 coefficients=coefficients,
+                                 intervention=intervention,
+                                 add_feature_var=False, n=100, seed=seed)
+            for i, node in enumerate(many["Nodes"]):
+                np.testing.assert_array_equal(many["Protein_data"][d, :, i],
+                                              data["Protein_data"][node])
+            if coefficients is None:
+                self.assertEqual(many["Coefficients"][d],
+                                 data["Coefficients"])
+
+    def test_matches_simulate_data(self):
+        self.assert_matches_simulate_data(self.sn["Coefficients"], dict())
+
+    def test_generated_coefficients_and_intervention(self):
+        self.assert_matches_simulate_data(None, {"Raf": 2.})
+
+    def test_feature_data(self):
+        many = simulate_many(self.sn["Networkx"], self.sn["Coefficients"],
+                             self.seeds, n=20, add_feature_var=True)
+
+        for seed, features in zip(self.seeds, many["Feature_data"]):
+            data = simulate_data(self.sn["Networkx"],
+                                 coefficients=self.sn["Coefficients"],
+                                 n=20, seed=seed)
+            pd.testing.assert_frame_equal(features, data["Feature_data"])
+
+
+class ExpectedValuesTestCase(unittest.TestCase):
+    def test_matches_simulated_means(self):
+        # The noise draws are shared under both interventions, so the
+        # difference of the simulated means is exact up to rounding
+        sn = signaling_network(add_independent_nodes=False)
+        int1, int2 = {"Ras": 0., "Akt": 0.}, {"Ras": 2., "Akt": -1.}
+        means = [expected_values(sn["Networkx"], sn["Coefficients"], i)
+                 for i in [int1, int2]]
+        data = [simulate_data(sn["Networkx"], coefficients=sn["Coefficients"],
+                              intervention=i, add_feature_var=False,
+                              n=10000, seed=2)["Protein_data"]
+                for i in [int1, int2]]
+
+        for node in ["Raf", "Mek", "Erk"]:
+            self.assertAlmostEqual(means[1][node] - means[0][node],
+                                   data[1][node].mean() -
+                                   data[0][node].mean(), places=10)
+        self.assertEqual(means[1]["Akt"], -1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
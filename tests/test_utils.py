@@ -0,0 +1,21 @@
+import unittest
+
+from y0.dsl import Variable
+from y0.graph import NxMixedGraph
+
+from MScausality.causal_model.utils import compile_graph
+
+
+class CompileGraphTestCase(unittest.TestCase):
+    def test_rewired_graph_is_recompiled(self):
+        a, b, c = Variable("A"), Variable("B"), Variable("C")
+        graph = NxMixedGraph.from_edges(directed=[(a, b), (b, c)])
+        self.assertEqual(compile_graph(graph)["descendent_nodes"]["C"], ["B"])
+
+        graph.directed.remove_edge(b, c)
+        graph.directed.add_edge(a, c)
+        self.assertEqual(compile_graph(graph)["descendent_nodes"]["C"], ["A"])
+
+
+if __name__ == '__main__':
+    unittest.main()
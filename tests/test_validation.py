@@ -0,0 +1,26 @@
+import unittest
+
+from MScausality.simulation.example_graphs import signaling_network
+
+try:
+    from MScausality.validation import analytic_ate, gt_ate
+except ImportError:
+    # validation needs eliater
+    analytic_ate = gt_ate = None
+
+
+@unittest.skipIf(gt_ate is None, "eliater is not installed")
+class AnalyticATETestCase(unittest.TestCase):
+    def test_matches_gt_ate(self):
+        sn = signaling_network(add_independent_nodes=False)
+        for int1, int2 in [({"Ras": 0.}, {"Ras": 1.}),
+                           ({"Ras": 0., "Akt": 0.}, {"Ras": 2., "Akt": -1.})]:
+            self.assertAlmostEqual(
+                analytic_ate(sn["Networkx"], sn["Coefficients"],
+                             int1, int2, "Erk"),
+                gt_ate(sn["Networkx"], sn["Coefficients"],
+                       int1, int2, "Erk"), places=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
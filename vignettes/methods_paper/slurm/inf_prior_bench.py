@@ -2,12 +2,16 @@ from MScausality.simulation.simulation import simulate_data
 from MScausality.data_analysis.dataProcess import dataProcess
 from MScausality.simulation.example_graphs import signaling_network
 from MScausality.validation import validate_model
+from MScausality.causal_model.LVM import configure_devices
 
 import numpy as np
 import pandas as pd
 import pickle
 import sys
 
+# Host devices for parallel MCMC chains, set before jax initializes
+configure_devices()
+
 def generate_sn_data(replicates, temp_seed, coef, priors):
 
     sn = signaling_network()
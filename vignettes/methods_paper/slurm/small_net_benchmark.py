@@ -1,4 +1,4 @@
-from MScausality.causal_model.LVM import LVM
+from MScausality.causal_model.LVM import LVM, configure_devices
 from MScausality.simulation.simulation import simulate_data
 from MScausality.data_analysis.normalization import normalize
 from MScausality.data_analysis.dataProcess import dataProcess
@@ -19,6 +19,9 @@ import pyro
 from concurrent.futures import ThreadPoolExecutor
 from sklearn.impute import KNNImputer
 
+# Host devices for parallel MCMC chains, set before jax initializes
+configure_devices()
+
 
 def intervention(model, int1, int2, outcome, scale_metrics):
     ## MScausality results